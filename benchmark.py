@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end benchmark of convert.py, run offline against a synthetic
+coursera-dl database and the local storage stand-in (STORAGE_BACKEND=local).
+
+Each stage runs in a process of its own, so that its peak RSS is its own:
+
+    generate      build the database and the media files
+    cold          first conversion, nothing uploaded yet
+    warm          conversion again, with the manifest and the stores filled
+    incremental   conversion with --incremental, nothing changed
+
+Usage:
+
+    python benchmark.py --courses 2 --modules 4 --items 10 -o new.json
+    python benchmark.py --courses 2 --modules 4 --items 10 --compare old.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import shutil
+import subprocess
+from collections import OrderedDict
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # Windows, no peak RSS.
+    resource = None
+
+STAGES = ["generate", "cold", "warm", "incremental"]
+
+DB_NAME = "coursera-dl.db"
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+         "tempor incididunt ut labore et dolore magna aliqua").split()
+
+
+def get_models():
+    from coursera.models import (
+        Course, Module, Lesson, Item, CourseAsset, ItemVideoAsset, ItemAsset, Reference)
+    return [Course, Module, Lesson, Item, CourseAsset, ItemVideoAsset, ItemAsset, Reference]
+
+
+def get_dummy_value(field, n):
+    """
+    Return a value for a required field the generator knows nothing about,
+    unique within the table.
+    """
+    from peewee import (
+        BooleanField, IntegerField, FloatField, DecimalField, DateTimeField, DateField)
+    if isinstance(field, BooleanField):
+        return False
+    if isinstance(field, (IntegerField, FloatField, DecimalField)):
+        return n
+    if isinstance(field, DateTimeField):
+        return datetime(2018, 1, 1)
+    if isinstance(field, DateField):
+        return datetime(2018, 1, 1).date()
+    return "%s-%d" % (field.name, n)
+
+
+class RowFactory(object):
+    """
+    Create rows, whatever the exact schema of ``coursera.models``: values
+    for fields the model does not have are dropped, required fields which
+    are not given get dummy values.
+    """
+    def __init__(self):
+        self.counts = {}
+
+    def create(self, model, **values):
+        from peewee import AutoField, ForeignKeyField
+
+        n = self.counts[model] = self.counts.get(model, 0) + 1
+        fields = model._meta.fields
+        row = dict((name, value) for name, value in values.items() if name in fields)
+        for name, field in fields.items():
+            if name in row or isinstance(field, AutoField) or field.null:
+                continue
+            if field.default is not None:
+                continue
+            if isinstance(field, ForeignKeyField):
+                raise RuntimeError(
+                    "Don't know how to fill %s.%s." % (model.__name__, name))
+            row[name] = get_dummy_value(field, n)
+        return model.create(**row)
+
+
+def random_bytes(rng, size):
+    return rng.getrandbits(8 * size).to_bytes(size, "little") if size else b""
+
+
+def random_text(rng, n_words):
+    return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def write_file(path, data):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def write_image(path, width, height):
+    from PIL import Image
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    Image.new("RGB", (width, height), (width % 256, height % 256, 128)).save(path)
+
+
+def get_page_content(rng, title, asset_tags, args):
+    paragraphs = ["<h1>%s</h1>" % title]
+    for i in range(args.paragraphs):
+        paragraphs.append(
+            "<p>%s &amp; $$x_%d$$ <b>%s</b>\n  :%s</p>"
+            % (random_text(rng, 40), i, random_text(rng, 3), random_text(rng, 5)))
+    for i, tag in enumerate(asset_tags):
+        paragraphs.insert(1 + (i * args.paragraphs) // max(len(asset_tags), 1), tag)
+    return "\n".join(paragraphs)
+
+
+def generate_database(args):
+    """
+    Write a coursera-dl database of ``args.courses`` courses of
+    ``args.modules`` modules of ``args.items`` items to the current
+    directory, and the files it refers to.
+    """
+    from peewee import SqliteDatabase
+
+    rng = random.Random(args.seed)
+    models = get_models()
+    Course, Module, Lesson, Item, CourseAsset, ItemVideoAsset, ItemAsset, Reference = models
+
+    database = SqliteDatabase(DB_NAME)
+    factory = RowFactory()
+    with database.bind_ctx(models):
+        database.create_tables(models)
+        for c in range(args.courses):
+            course_slug = "bench-course-%d" % c
+            files_dir = os.path.join(course_slug, "files")
+
+            with database.atomic():
+                course = factory.create(
+                    Course, course_id="course-%d" % c, course_slug=course_slug,
+                    course_name="Benchmark Course %d" % c)
+
+                def create_asset(asset_id, asset_type, path):
+                    return factory.create(
+                        CourseAsset, course=course, asset_id=asset_id,
+                        name="Asset %s" % asset_id, asset_type=asset_type, saved_path=path)
+
+                for m in range(args.modules):
+                    module = factory.create(
+                        Module, course=course, module_id="c%dm%d" % (c, m),
+                        slug="module-%d" % m, name="Module %d" % m,
+                        description="<p>%s</p>" % random_text(rng, 20))
+                    lesson = factory.create(
+                        Lesson, module=module, lesson_id="c%dm%dl" % (c, m),
+                        slug="lesson-%d" % m, name="Lesson %d" % m)
+
+                    for i in range(args.items):
+                        prefix = "c%dm%di%d" % (c, m, i)
+                        values = dict(lesson=lesson, module=module, item_id=prefix,
+                                      slug="item-%d-%d" % (m, i), name="Item %d.%d" % (m, i))
+
+                        if rng.random() < args.lecture_ratio:
+                            item = factory.create(Item, type_name="lecture", content=None, **values)
+                            video_path = os.path.join(files_dir, "%s.mp4" % prefix)
+                            write_file(video_path, random_bytes(rng, args.video_size))
+                            for lang in ["en", "zh-CN"]:
+                                write_file(os.path.join(files_dir, "%s.%s.vtt" % (prefix, lang)),
+                                           b"WEBVTT\n\n" + random_text(rng, 200).encode())
+                            factory.create(ItemVideoAsset, item=item, saved_path=video_path,
+                                           subtitles="en.vtt,zh-CN.vtt")
+                            asset_path = os.path.join(files_dir, "%s-slides.pdf" % prefix)
+                            write_file(asset_path, random_bytes(rng, args.asset_size))
+                            factory.create(ItemAsset, item=item, asset=create_asset(
+                                "%s-slides" % prefix, "pdf", asset_path))
+                            continue
+
+                        asset_tags = []
+                        for k in range(args.assets_per_page):
+                            asset_id = "%sa%d" % (prefix, k)
+                            asset_path = os.path.join(files_dir, "%s.pdf" % asset_id)
+                            write_file(asset_path, random_bytes(rng, args.asset_size))
+                            create_asset(asset_id, "pdf", asset_path)
+                            asset_tags.append(
+                                '<asset assettype="pdf" extension="pdf" id="%s" name="Asset %s">'
+                                '</asset>' % (asset_id, asset_id))
+                        for k in range(args.images_per_page):
+                            asset_id = "%simg%d" % (prefix, k)
+                            image_path = os.path.join(files_dir, "%s.png" % asset_id)
+                            # Half of the images are wider than IMAGE_WIDTHS.
+                            width = args.image_width if k % 2 == 0 else args.image_width // 4
+                            write_image(image_path, width, width // 2)
+                            create_asset(asset_id, "image", image_path)
+                            asset_tags.append(
+                                '<img src="%s.png" assetid="%s"/>' % (asset_id, asset_id))
+
+                        factory.create(Item, type_name="supplement", content=get_page_content(
+                            rng, values["name"], asset_tags, args), **values)
+
+                for r in range(args.references):
+                    factory.create(
+                        Reference, course=course, reference_id="c%dr%d" % (c, r),
+                        slug="reference-%d" % r, name="Reference %d" % r,
+                        content=get_page_content(rng, "Reference %d" % r, [], args))
+
+
+class QueryCounter(logging.Handler):
+    """
+    Count the queries peewee logs.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self, logging.DEBUG)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def run_conversion(stage, args):
+    os.environ["STORAGE_BACKEND"] = "local"
+    os.environ["LOCAL_STORAGE_DIR"] = os.path.join(os.getcwd(), "storage")
+    os.environ["LOCAL_STORAGE_LATENCY"] = str(args.latency)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import convert
+
+    argv = ["convert.py", "--jobs", str(args.jobs)]
+    if stage == "incremental":
+        argv.append("--incremental")
+    sys.argv = argv
+    convert.main()
+
+    # The run report includes the --jobs workers. What convert.py hashed
+    # itself, the local stores hash the files they keep too.
+    operations = convert.instrumentation.get_report()["operations"]
+
+    def get_total(names, field):
+        return sum(operations[name][field] for name in names if name in operations)
+
+    stores = ["qiniu", "dropbox"]
+    stats = {
+        "queries": get_total(["query", "cache_query"], "count"),
+        "bytes_hashed": get_total(["hash", "dropbox_hash"], "bytes"),
+        "uploads": get_total(["local_%s_write" % name for name in stores], "count"),
+        "bytes_uploaded": get_total(["local_%s_write" % name for name in stores], "bytes"),
+        "store_requests": get_total(["local_%s_request" % name for name in stores], "count"),
+    }
+
+    query_stats = operations.get("query")
+    stats["query_time"] = query_stats["time"] if query_stats else 0.
+    return stats
+
+
+def get_peak_rss(who):
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_stage(stage, args):
+    """
+    Run ``stage`` in the work directory, in this process, and write its
+    results to ``<stage>.json``.
+    """
+    os.chdir(args.work_dir)
+
+    # convert.py writes to the real stdout, redirect the file descriptors.
+    log_file = open("%s.log" % stage, "w")
+    os.dup2(log_file.fileno(), 1)
+    os.dup2(log_file.fileno(), 2)
+
+    query_counter = QueryCounter()
+    logger = logging.getLogger("peewee")
+    logger.addHandler(query_counter)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+    start = time.time()
+    if stage == "generate":
+        generate_database(args)
+        stats = {}
+    else:
+        stats = run_conversion(stage, args)
+    stats["wall_time"] = time.time() - start
+    # The queries of the conversions are in their report.
+    stats.setdefault("queries", query_counter.count)
+    stats["peak_rss"] = get_peak_rss(resource.RUSAGE_SELF) if resource else None
+    stats["peak_children_rss"] = get_peak_rss(resource.RUSAGE_CHILDREN) if resource else None
+
+    with open("%s.json" % stage, "w") as f:
+        json.dump(stats, f)
+
+
+def get_label():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+METRICS = ["wall_time", "queries", "query_time", "bytes_hashed", "uploads", "bytes_uploaded",
+           "store_requests", "peak_rss", "peak_children_rss"]
+
+
+def format_value(metric, value):
+    if value is None:
+        return "-"
+    if metric in ("wall_time", "query_time"):
+        return "%.2fs" % value
+    if metric in ("bytes_hashed", "bytes_uploaded", "peak_rss", "peak_children_rss"):
+        return "%.1fM" % (value / 1024 / 1024)
+    return str(value)
+
+
+def write_report(results, previous=None):
+    for stage, stats in results["stages"].items():
+        sys.stdout.write("%s:\n" % stage)
+        for metric in METRICS:
+            if metric not in stats:
+                continue
+            line = "    %-18s %10s" % (metric, format_value(metric, stats[metric]))
+            old = (previous or {}).get("stages", {}).get(stage, {}).get(metric)
+            if old is not None and stats[metric] is not None:
+                line += "  (was %s" % format_value(metric, old)
+                if old:
+                    line += ", x%.2f" % (stats[metric] / old)
+                line += ")"
+            sys.stdout.write(line + "\n")
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark convert.py against a synthetic coursera-dl database.")
+    parser.add_argument("--courses", type=int, default=1)
+    parser.add_argument("--modules", type=int, default=4,
+                        help="Modules per course (default: %(default)s).")
+    parser.add_argument("--items", type=int, default=8,
+                        help="Items per module (default: %(default)s).")
+    parser.add_argument("--references", type=int, default=2,
+                        help="References per course (default: %(default)s).")
+    parser.add_argument("--lecture-ratio", type=float, default=0.3,
+                        help="Share of the items which are videos (default: %(default)s).")
+    parser.add_argument("--assets-per-page", type=int, default=3)
+    parser.add_argument("--images-per-page", type=int, default=2)
+    parser.add_argument("--paragraphs", type=int, default=20,
+                        help="Paragraphs per page (default: %(default)s).")
+    parser.add_argument("--asset-size", type=int, default=64 * 1024,
+                        help="Size of the documents, in bytes (default: %(default)s).")
+    parser.add_argument("--video-size", type=int, default=1024 * 1024,
+                        help="Size of the videos, in bytes (default: %(default)s).")
+    parser.add_argument("--image-width", type=int, default=1600,
+                        help="Width of the large images (default: %(default)s).")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.,
+                        help="Seconds each request to the stores takes (default: %(default)s).")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="--jobs of convert.py (default: %(default)s).")
+    parser.add_argument("--work-dir",
+                        help="Directory to run in, kept afterwards (default: a temporary one).")
+    parser.add_argument("-o", "--output", default="benchmark-results.json",
+                        help="File to save the results to (default: %(default)s).")
+    parser.add_argument("--compare", help="Results of a previous run to compare with.")
+    parser.add_argument("--label", default=None,
+                        help="Label of the results (default: the git commit).")
+    parser.add_argument("--stage", choices=STAGES, help=argparse.SUPPRESS)
+    return parser
+
+
+def main():
+    args = get_argument_parser().parse_args()
+    if args.stage:
+        run_stage(args.stage, args)
+        return
+
+    keep_work_dir = bool(args.work_dir)
+    if args.work_dir:
+        if os.path.exists(args.work_dir) and os.listdir(args.work_dir):
+            sys.exit("%s is not empty." % args.work_dir)
+        if not os.path.isdir(args.work_dir):
+            os.makedirs(args.work_dir)
+    else:
+        args.work_dir = tempfile.mkdtemp(prefix="convert-benchmark-")
+    args.work_dir = os.path.abspath(args.work_dir)
+
+    params = OrderedDict((name, getattr(args, name)) for name in [
+        "courses", "modules", "items", "references", "lecture_ratio", "assets_per_page",
+        "images_per_page", "paragraphs", "asset_size", "video_size", "image_width",
+        "seed", "latency", "jobs"])
+    results = OrderedDict([
+        ("label", args.label if args.label is not None else get_label()),
+        ("time", datetime.now().isoformat()),
+        ("python", platform.python_version()),
+        ("platform", platform.platform()),
+        ("params", params),
+        ("stages", OrderedDict()),
+    ])
+
+    argv = [sys.executable, os.path.abspath(__file__), "--work-dir", args.work_dir]
+    for name, value in params.items():
+        argv += ["--%s" % name.replace("_", "-"), str(value)]
+
+    try:
+        for stage in STAGES:
+            sys.stdout.write("Running %s...\n" % stage)
+            sys.stdout.flush()
+            returncode = subprocess.call(argv + ["--stage", stage])
+            if returncode:
+                keep_work_dir = True
+                sys.exit("Stage %s failed, see %s."
+                         % (stage, os.path.join(args.work_dir, "%s.log" % stage)))
+            with open(os.path.join(args.work_dir, "%s.json" % stage)) as f:
+                results["stages"][stage] = json.load(f)
+    finally:
+        if not keep_work_dir:
+            shutil.rmtree(args.work_dir, ignore_errors=True)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    write_report(results, previous)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    sys.stdout.write("Results saved to %s.\n" % args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,15 +5,44 @@ from datetime import datetime
 import sys
 import jinja2
 import re
-from peewee import SqliteDatabase, OperationalError
+import threading
+import time
+import json
+import hashlib
+import multiprocessing
+import sqlite3
+import tempfile
+import shutil
+import zlib
+import tarfile
+import codecs
+import queue
+import mmap
+import random
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from peewee import SqliteDatabase, OperationalError, Model, CharField, IntegerField
 from coursera.models import (
     Module, Lesson, Item, ItemVideoAsset, ItemAsset, Reference, CourseAsset, Course)
 from django.conf.global_settings import LANGUAGES
 from coursera.utils import BeautifulSoup
 from bs4 import NavigableString
-from qiniu import Auth, put_file, etag, BucketManager, DomainManager
+from qiniu import (
+    Auth, put_file, put_data, BucketManager, DomainManager, UploadProgressRecorder,
+    build_batch_stat, build_batch_delete)
+from qiniu import put_stream, urlsafe_base64_encode
+from qiniu import config as qiniu_config
 import html
+import posixpath
 from posixpath import join
+from functools import partial
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where nothing is uploaded.
+    fcntl = None
 
 sys.stdout = sys.__stdout__
 sys.stderr = sys.__stderr__
@@ -22,7 +51,50 @@ LOCAL_PATH_PREFIX = os.getcwd()
 
 DB_PATH = os.path.join(LOCAL_PATH_PREFIX, "coursera-dl.db")
 
-database = SqliteDatabase(DB_PATH)
+
+class TimedSqliteDatabase(SqliteDatabase):
+    """
+    A SqliteDatabase whose queries are timed as ``operation`` in the run
+    report: the time to execute them and step to their first row.
+    """
+    def __init__(self, database, operation="query", **kwargs):
+        super(TimedSqliteDatabase, self).__init__(database, **kwargs)
+        self.operation = operation
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        with instrumentation.timer(self.operation):
+            return super(TimedSqliteDatabase, self).execute_sql(sql, params, *args, **kwargs)
+
+
+# The coursera-dl database is only read, through a connection per thread
+# (and per --jobs worker) which stays open for the run, outside of
+# transactions so that it does not hold back the WAL of the downloader
+# writing to it meanwhile. query_only keeps the converter from writing to it.
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_CACHE_SIZE = int(os.environ.get("DB_CACHE_SIZE", str(64 * 1024 * 1024)))
+
+database = TimedSqliteDatabase(
+    DB_PATH, pragmas={"query_only": 1, "mmap_size": DB_MMAP_SIZE,
+                      "cache_size": -(DB_CACHE_SIZE // 1024)},
+    timeout=30)
+database.bind([Module, Lesson, Item, ItemVideoAsset, ItemAsset, Reference, CourseAsset, Course])
+
+# Local state of the converter (upload manifest etc.), kept next to the
+# coursera-dl database so that it survives between runs.
+CACHE_DB_PATH = os.path.join(LOCAL_PATH_PREFIX, "convert-cache.db")
+
+# WAL, so that the worker processes of --jobs can use it concurrently. As for
+# the coursera-dl database, each thread connects once and keeps its
+# connection for the run, only writes are wrapped in transactions.
+cache_database = TimedSqliteDatabase(
+    CACHE_DB_PATH, operation="cache_query", pragmas={"journal_mode": "wal"}, timeout=30)
+
+# Ignore the upload manifest and re-hash / re-stat every file.
+FORCE_VERIFY = bool(os.environ.get("FORCE_VERIFY", ""))
+
+# Only regenerate and publish the files whose inputs changed since they were
+# last published.
+INCREMENTAL = bool(os.environ.get("INCREMENTAL", ""))
 
 upload_to_qiniu = False
 QINIU_ACCESS_KEY = os.environ.get("QINIU_ACCESS_KEY", "")
@@ -31,10 +103,75 @@ QINIU_BUCKET_NAME = os.environ.get("QINIU_BUCKET_NAME", "")
 QINIU_VIDEO_BUCKET_PREFIX = os.environ.get("QINIU_VIDEO_BUCKET_PREFIX", "")
 IN_BUCKET_PREFIX = "coursera-videos"
 
+# Number of concurrent uploads to Qiniu.
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "4"))
+
+# Number of operations sent to Qiniu in one batch request (at most 1000).
+QINIU_BATCH_SIZE = int(os.environ.get("QINIU_BATCH_SIZE", "500"))
+
+# The video bucket is the latest bucket named QINIU_VIDEO_BUCKET_PREFIX*
+# which is the source of a domain, found by querying every domain. The result
+# is cached in BUCKET_CACHE_PATH for BUCKET_CACHE_TTL seconds.
+BUCKET_CACHE_PATH = os.path.join(LOCAL_PATH_PREFIX, ".qiniu-bucket-cache.json")
+BUCKET_CACHE_TTL = int(os.environ.get("BUCKET_CACHE_TTL", str(24 * 3600)))
+DOMAIN_INFO_WORKERS = 8
+
+# Images are shrunk to the first of IMAGE_WIDTHS before they are uploaded,
+# variants for the other widths (e.g. thumbnails) are generated alongside.
+# Resized images are cached in IMAGE_CACHE_DIR, keyed by the hash of the
+# original and the width, the originals are never modified.
+IMAGE_EXTENSIONS = [".jpg", ".png", ".gif"]
+IMAGE_WIDTHS = [int(width) for width in os.environ.get("IMAGE_WIDTHS", "1024").split(",")]
+IMAGE_CACHE_DIR = os.path.join(LOCAL_PATH_PREFIX, ".image-cache")
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", str(os.cpu_count() or 1)))
+
+# Lock files which keep several processes (--jobs) from uploading the same
+# file at the same time.
+UPLOAD_LOCK_DIR = os.path.join(LOCAL_PATH_PREFIX, ".upload-locks")
+
+# Files larger than this are uploaded block by block, with the progress
+# recorded in UPLOAD_RECORD_DIR so that an interrupted upload resumes from the
+# last completed block on the next attempt (or the next run).
+RESUMABLE_UPLOAD_THRESHOLD = int(
+    os.environ.get("RESUMABLE_UPLOAD_THRESHOLD", str(8 * 1024 * 1024)))
+UPLOAD_RECORD_DIR = os.path.join(LOCAL_PATH_PREFIX, ".qiniu-upload-records")
+
+# A call to Qiniu or Dropbox which failed in a way which may not last
+# (connection errors, server errors, rate limits) is attempted at most
+# REMOTE_RETRIES times, waiting up to REMOTE_RETRY_DELAY seconds (at random)
+# after the first failure, up to twice as long after each of the following
+# ones, and never more than REMOTE_MAX_RETRY_DELAY. Requests time out after
+# REMOTE_TIMEOUT seconds without a response.
+REMOTE_RETRIES = int(os.environ.get("REMOTE_RETRIES", "5"))
+REMOTE_RETRY_DELAY = float(os.environ.get("REMOTE_RETRY_DELAY", "2"))
+REMOTE_MAX_RETRY_DELAY = float(os.environ.get("REMOTE_MAX_RETRY_DELAY", "60"))
+REMOTE_TIMEOUT = float(os.environ.get("REMOTE_TIMEOUT", "60"))
+
+# After REMOTE_BREAKER_THRESHOLD failed attempts in a row at calling a
+# service, the calls to it fail at once for REMOTE_BREAKER_COOLDOWN seconds,
+# instead of each going through its retries.
+REMOTE_BREAKER_THRESHOLD = int(os.environ.get("REMOTE_BREAKER_THRESHOLD", "10"))
+REMOTE_BREAKER_COOLDOWN = float(os.environ.get("REMOTE_BREAKER_COOLDOWN", "60"))
+
+# Connections kept alive to each host of Qiniu and Dropbox.
+REMOTE_POOL_SIZE = int(os.environ.get("REMOTE_POOL_SIZE", "16"))
+
+# Where files are uploaded to: "" for Qiniu and Dropbox, or "local" for
+# stand-ins of both which keep the files in LOCAL_STORAGE_DIR (or in memory if
+# it is set to an empty string), to run offline. Each request to the
+# stand-ins takes LOCAL_STORAGE_LATENCY seconds.
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "")
+LOCAL_STORAGE_DIR = os.environ.get(
+    "LOCAL_STORAGE_DIR", os.path.join(LOCAL_PATH_PREFIX, ".local-storage"))
+LOCAL_STORAGE_LATENCY = float(os.environ.get("LOCAL_STORAGE_LATENCY", "0"))
+
 auth = None
 bm = None
+dm = None
 
-if (not sys.platform.startswith("win")
+if STORAGE_BACKEND == "local":
+    upload_to_qiniu = True
+elif (not sys.platform.startswith("win")
         and QINIU_ACCESS_KEY and QINIU_SECRET_KEY and QINIU_BUCKET_NAME and QINIU_VIDEO_BUCKET_PREFIX):
     upload_to_qiniu = True
     auth = Auth(QINIU_ACCESS_KEY, QINIU_SECRET_KEY)
@@ -154,35 +291,108 @@ chunks:
 """
 
 
-def get_source_bucket(domain_name, retries=10):
-    n = 0
-    ret = None
-    while n < retries:
-        try:
-            ret, info = dm.get_domain_info(domain_name)
-            assert info.status_code == 200
-            return ret["source"]["sourceQiniuBucket"]
-        except AssertionError:
-            n += 1
-    assert ret is not None
-
-
-def get_latest_bucket_name(retries=10, prefix=QINIU_VIDEO_BUCKET_PREFIX):
-    n = 0
-    ret = None
-    while n < retries:
-        try:
-            ret, resp = dm.get_domains(limit=1000)
-            assert resp.status_code == 200
-            break
-        except AssertionError:
-            n += 1
-    assert ret is not None
-    domains = ret["domains"]
+TEMPLATES = {
+    "flow": flow_template,
+    "video": video_template,
+    "resource": resource_template,
+    "course_chunks_embed": course_chunks_template_embed,
+    "course_chunks_single": course_chunks_template_single,
+}
+
+# Compiled templates are also cached on disk between runs. Set to an empty
+# string to disable.
+TEMPLATE_CACHE_DIR = os.environ.get(
+    "TEMPLATE_CACHE_DIR", os.path.join(LOCAL_PATH_PREFIX, ".jinja-cache"))
+
+jinja_env = None
+jinja_env_lock = threading.Lock()
+
+
+def get_jinja_env():
+    """
+    Return the environment shared by all the renderings, in which each of
+    the TEMPLATES is only compiled once.
+    """
+    global jinja_env
+    with jinja_env_lock:
+        if jinja_env is None:
+            bytecode_cache = None
+            if TEMPLATE_CACHE_DIR:
+                os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+                bytecode_cache = jinja2.FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+            jinja_env = jinja2.Environment(
+                loader=jinja2.DictLoader(TEMPLATES), bytecode_cache=bytecode_cache,
+                cache_size=-1)
+    return jinja_env
+
+
+def render_template(template_name, **context):
+    """
+    Render a template which is part of a page. Its time is counted as
+    "render_page", as it is already in the "render" time of the file the
+    page is rendered in.
+    """
+    with instrumentation.timer("render_page"):
+        return get_jinja_env().get_template(template_name).render(**context)
+
+
+# Rendered files are written in pieces of this size, and kept in memory up to
+# RENDER_SPOOL_SIZE, on disk above it.
+RENDER_WRITE_SIZE = 64 * 1024
+RENDER_SPOOL_SIZE = int(os.environ.get("RENDER_SPOOL_SIZE", str(8 * 1024 * 1024)))
+
+
+def render_template_to_file(template_name, **context):
+    """
+    Render a template piece by piece into a temporary binary file, rewound,
+    instead of into a string. Iterables in the context, such as the pages of
+    a flow, are only consumed as the output is written.
+    """
+    output = tempfile.SpooledTemporaryFile(max_size=RENDER_SPOOL_SIZE)
+    with instrumentation.timer("render"):
+        pieces = []
+        size = 0
+        for piece in get_jinja_env().get_template(template_name).generate(**context):
+            pieces.append(piece)
+            size += len(piece)
+            if size >= RENDER_WRITE_SIZE:
+                output.write("".join(pieces).encode("utf-8"))
+                pieces = []
+                size = 0
+        output.write("".join(pieces).encode("utf-8"))
+    output.seek(0)
+    return output
+
+
+def get_templates_fingerprint():
+    return get_fingerprint(sorted(TEMPLATES.items()))
+
+
+def get_source_bucket(domain_name):
+    def get_domain_info():
+        ret, info = dm.get_domain_info(domain_name)
+        check_qiniu_response(info, "Getting the domain '%s'" % domain_name)
+        return ret
+
+    return qiniu_retry_policy.call(get_domain_info)["source"]["sourceQiniuBucket"]
+
+
+def get_latest_bucket_name(prefix=QINIU_VIDEO_BUCKET_PREFIX):
+    def get_domains():
+        ret, info = dm.get_domains(limit=1000)
+        check_qiniu_response(info, "Listing the domains")
+        return ret
+
+    domains = qiniu_retry_policy.call(get_domains)["domains"]
+
+    # The domain infos are independent requests, fetch them concurrently.
+    with ThreadPoolExecutor(max_workers=DOMAIN_INFO_WORKERS) as executor:
+        source_buckets = list(executor.map(
+            get_source_bucket, [domain["name"] for domain in domains]))
+
     latest_date = None
     latest_bucket = None
-    for domain in domains:
-        current_bucket = get_source_bucket(domain["name"])
+    for domain, current_bucket in zip(domains, source_buckets):
         if latest_bucket is None and current_bucket.startswith(prefix):
             latest_bucket = current_bucket
         current_date = datetime.strptime(domain["createAt"].split(".")[0], '%Y-%m-%dT%H:%M:%S')
@@ -194,7 +404,398 @@ def get_latest_bucket_name(retries=10, prefix=QINIU_VIDEO_BUCKET_PREFIX):
     return latest_bucket
 
 
-qiniu_video_bucket_name = get_latest_bucket_name()
+def get_cached_video_bucket_name(prefix=QINIU_VIDEO_BUCKET_PREFIX):
+    try:
+        with open(BUCKET_CACHE_PATH, "r") as f:
+            cached = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if cached.get("prefix") != prefix or time.time() - cached.get("time", 0) > BUCKET_CACHE_TTL:
+        return None
+    return cached.get("bucket")
+
+
+_video_bucket_name = None
+_video_bucket_lock = threading.Lock()
+
+
+def get_video_bucket_name():
+    """
+    Return the name of the bucket videos are uploaded to. It is only looked
+    up when it is first needed, and cached on disk for BUCKET_CACHE_TTL
+    seconds.
+    """
+    global _video_bucket_name
+    with _video_bucket_lock:
+        if _video_bucket_name is None:
+            _video_bucket_name = get_qiniu_store().find_video_bucket(QINIU_VIDEO_BUCKET_PREFIX)
+    return _video_bucket_name
+
+
+class UploadManifest(Model):
+    """
+    What we know about a local file since it was last uploaded: its etag, and
+    the bucket and key it was stored with. An entry is only valid as long as
+    the size and mtime of the file are unchanged, and for an image as long
+    as the width it was resized to (``width``) is the one of the run.
+    """
+    path = CharField(primary_key=True)
+    size = IntegerField()
+    mtime = IntegerField()
+    etag = CharField()
+    bucket = CharField(null=True)
+    key = CharField(null=True)
+    width = IntegerField(null=True)
+
+    class Meta:
+        database = cache_database
+        table_name = "upload_manifest"
+
+
+class BuildFingerprint(Model):
+    """
+    Fingerprint of the inputs a published file was generated from, keyed by
+    its Dropbox path.
+    """
+    path = CharField(primary_key=True)
+    fingerprint = CharField()
+
+    class Meta:
+        database = cache_database
+        table_name = "build_fingerprint"
+
+
+def init_cache_database():
+    with cache_database.atomic():
+        cache_database.create_tables([UploadManifest, BuildFingerprint], safe=True)
+
+        # Added after the table, the entries without it are not valid for
+        # images.
+        columns = [column.name for column in cache_database.get_columns("upload_manifest")]
+        if "width" not in columns:
+            cache_database.execute_sql("ALTER TABLE upload_manifest ADD COLUMN width INTEGER")
+
+
+def get_manifest_entry(file_path):
+    """
+    Return the manifest entry of ``file_path``, or None if there isn't one or
+    the file was changed after the entry was recorded.
+    """
+    file_path = os.path.normpath(file_path)
+    file_stat = os.stat(file_path)
+    try:
+        entry = UploadManifest.get(path=file_path)
+    except UploadManifest.DoesNotExist:
+        return None
+
+    if entry.size != file_stat.st_size or entry.mtime != file_stat.st_mtime_ns:
+        return None
+    if entry.width != get_upload_width(file_path):
+        return None
+    return entry
+
+
+def update_manifest(file_path, file_etag, bucket_name, key):
+    file_path = os.path.normpath(file_path)
+    file_stat = os.stat(file_path)
+    with cache_database.atomic():
+        UploadManifest.replace(
+            path=file_path, size=file_stat.st_size, mtime=file_stat.st_mtime_ns,
+            etag=file_etag, bucket=bucket_name, key=key,
+            width=get_upload_width(file_path)).execute()
+
+
+# (path, reason) of the files generated in this run, reason is None for the
+# files skipped because their inputs did not change.
+build_summary = []
+
+
+def get_fingerprint(data):
+    return hashlib.sha1(
+        json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def get_rebuild_reason(path, fingerprint, incremental=None):
+    """
+    Return why the file published at ``path`` has to be generated again, or
+    None if it is up to date.
+    """
+    if incremental is None:
+        incremental = INCREMENTAL
+    if not incremental:
+        return "full rebuild"
+
+    try:
+        stored = BuildFingerprint.get(path=path).fingerprint
+    except BuildFingerprint.DoesNotExist:
+        return "not built before"
+
+    if stored != fingerprint:
+        return "inputs changed"
+    return None
+
+
+def record_build(path, reason):
+    build_summary.append((path, reason))
+
+
+def store_fingerprint(path, fingerprint):
+    with cache_database.atomic():
+        BuildFingerprint.replace(path=path, fingerprint=fingerprint).execute()
+
+
+def write_build_summary():
+    rebuilt = [(path, reason) for path, reason in build_summary if reason is not None]
+    sys.stdout.write(
+        "%d of %d files rebuilt.\n" % (len(rebuilt), len(build_summary)))
+    for path, reason in rebuilt:
+        sys.stdout.write("    %s: %s\n" % (path, reason))
+
+
+# Where to write the timings and counters of the run, as JSON or as CSV
+# (by the extension of the file). No report if empty.
+RUN_REPORT_PATH = os.environ.get("RUN_REPORT_PATH", "")
+
+# Number of the slowest pages listed in the report.
+RUN_REPORT_SLOWEST_ITEMS = 20
+
+
+class Instrumentation(object):
+    """
+    Timers and counters of the operations of a run ("hash", "upload",
+    "render"...), totalled for the run and for each course, flow and item
+    they are done for.
+
+    The stats are a dict of (scope, label, operation) -> [count, seconds,
+    bytes], which :meth:`pop` and :meth:`merge` move between processes.
+    """
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+
+    def add(self, operation, duration=0., n_bytes=0, course=None, flow=None, item=None):
+        keys = [("total", "")]
+        if course:
+            keys.append(("course", course))
+        if flow:
+            keys.append(("flow", flow))
+        if item:
+            keys.append(("item", "%s/%s" % (flow, item) if flow else item))
+        with self._lock:
+            for scope, label in keys:
+                stats = self._stats.setdefault((scope, label, operation), [0, 0., 0])
+                stats[0] += 1
+                stats[1] += duration
+                stats[2] += n_bytes
+
+    @contextmanager
+    def timer(self, operation, n_bytes=0, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(operation, time.time() - start, n_bytes, **labels)
+
+    def pop(self):
+        """
+        Return the stats collected so far, and start afresh.
+        """
+        with self._lock:
+            stats = self._stats
+            self._stats = {}
+        return stats
+
+    def merge(self, stats):
+        with self._lock:
+            for key, (count, duration, n_bytes) in stats.items():
+                merged = self._stats.setdefault(key, [0, 0., 0])
+                merged[0] += count
+                merged[1] += duration
+                merged[2] += n_bytes
+
+    def get_report(self, n_slowest=RUN_REPORT_SLOWEST_ITEMS):
+        report = OrderedDict([
+            ("duration", time.time() - self.start_time),
+            ("operations", OrderedDict()),
+            ("courses", OrderedDict()),
+            ("flows", OrderedDict()),
+            ("slowest_items", []),
+        ])
+        groups = {"total": report["operations"], "course": report["courses"],
+                  "flow": report["flows"]}
+        item_times = {}
+        with self._lock:
+            for (scope, label, operation), (count, duration, n_bytes) in sorted(self._stats.items()):
+                entry = OrderedDict([("count", count), ("time", duration), ("bytes", n_bytes)])
+                if scope == "total":
+                    groups[scope][operation] = entry
+                elif scope == "item":
+                    item_times[label] = item_times.get(label, 0.) + duration
+                else:
+                    groups[scope].setdefault(label, OrderedDict())[operation] = entry
+
+        for label, duration in sorted(item_times.items(), key=lambda x: -x[1])[:n_slowest]:
+            report["slowest_items"].append(OrderedDict([("item", label), ("time", duration)]))
+        return report
+
+    def write_report(self, path):
+        report = self.get_report()
+        if not path.lower().endswith(".csv"):
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+            return
+
+        import csv
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["scope", "label", "operation", "count", "time", "bytes"])
+            writer.writerow(["run", "", "duration", "", "%.6f" % report["duration"], ""])
+            rows = [("total", "", report["operations"])]
+            rows.extend(("course", label, ops) for label, ops in report["courses"].items())
+            rows.extend(("flow", label, ops) for label, ops in report["flows"].items())
+            for scope, label, operations in rows:
+                for operation, entry in operations.items():
+                    writer.writerow([scope, label, operation, entry["count"],
+                                     "%.6f" % entry["time"], entry["bytes"]])
+            for entry in report["slowest_items"]:
+                writer.writerow(["item", entry["item"], "page", "", "%.6f" % entry["time"], ""])
+
+
+instrumentation = Instrumentation()
+
+
+def write_query_stats():
+    operations = instrumentation.get_report()["operations"]
+    for operation, name in [("query", "coursera-dl"), ("cache_query", "cache")]:
+        entry = operations.get(operation)
+        if entry:
+            sys.stdout.write("%s database: %d queries, %.2fs.\n"
+                             % (name, entry["count"], entry["time"]))
+
+
+def get_lookup_fields():
+    """
+    Return the fields of the coursera-dl models the rows are looked up or
+    joined by.
+    """
+    fields = [Course.course_slug, Module.slug, Item.item_id, CourseAsset.asset_id]
+    for model, rel_model in [(Module, Course), (Item, Module), (ItemVideoAsset, Item),
+                             (ItemAsset, Item), (Reference, Course)]:
+        fields.extend(field for field in model._meta.refs if field.rel_model is rel_model)
+    return fields
+
+
+def ensure_lookup_indexes(create=True):
+    """
+    Check that the column of each lookup field leads an index of the
+    coursera-dl database, whatever schema the downloader gave it, and create
+    the missing indexes through a short-lived connection of their own (the
+    others are read-only). Return the (table, column) still without one.
+    """
+    missing = []
+    connection = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        for field in get_lookup_fields():
+            table = field.model._meta.table_name
+            column = field.column_name
+            if not connection.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                    (table,)).fetchone():
+                continue
+
+            leading_columns = set()
+            for index in connection.execute('PRAGMA index_list("%s")' % table).fetchall():
+                for seqno, _, name in connection.execute('PRAGMA index_info("%s")' % index[1]):
+                    if seqno == 0:
+                        leading_columns.add(name)
+            if column in leading_columns:
+                continue
+
+            if not create:
+                sys.stdout.write("No index on %s.%s.\n" % (table, column))
+                missing.append((table, column))
+                continue
+            try:
+                connection.execute('CREATE INDEX IF NOT EXISTS "convert_%s_%s" ON "%s" ("%s")'
+                                   % (table, column, table, column))
+                connection.commit()
+                sys.stdout.write("Created an index on %s.%s.\n" % (table, column))
+            except sqlite3.OperationalError as e:
+                # E.g. the downloader holds a write lock for too long.
+                sys.stdout.write("Could not index %s.%s: %s\n" % (table, column, e))
+                missing.append((table, column))
+    finally:
+        connection.close()
+    return missing
+
+
+# Files are hashed in blocks of QINIU_BLOCK_SIZE, by HASH_WORKERS threads
+# (hashlib releases the GIL while it hashes a block).
+QINIU_BLOCK_SIZE = 4 * 1024 * 1024
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", str(os.cpu_count() or 1)))
+
+_hash_executor = None
+_hash_executor_lock = threading.Lock()
+
+
+def _sha1_block(view, start):
+    with view[start:start + QINIU_BLOCK_SIZE] as block:
+        return hashlib.sha1(block).digest()
+
+
+def qiniu_etag(buffer):
+    """
+    Return the qiniu etag of ``buffer`` (bytes or a mapped file), the same as
+    qiniu.etag: the SHA-1 of its only 4M block, or the SHA-1 of the SHA-1s of
+    its blocks, which are hashed in parallel.
+    """
+    global _hash_executor
+    with memoryview(buffer) as view:
+        if len(view) <= QINIU_BLOCK_SIZE or HASH_WORKERS < 2:
+            digests = [_sha1_block(view, start)
+                       for start in range(0, max(len(view), 1), QINIU_BLOCK_SIZE)]
+        else:
+            with _hash_executor_lock:
+                if _hash_executor is None:
+                    _hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS)
+            digests = list(_hash_executor.map(
+                partial(_sha1_block, view), range(0, len(view), QINIU_BLOCK_SIZE)))
+
+    if len(digests) == 1:
+        return urlsafe_base64_encode(b"\x16" + digests[0])
+    return urlsafe_base64_encode(b"\x96" + hashlib.sha1(b"".join(digests)).digest())
+
+
+@contextmanager
+def map_file(file_path):
+    """
+    Map the file in memory, read-only, while in the context. An empty file,
+    which can't be mapped, is an empty bytes.
+    """
+    with open(file_path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            yield b""
+            return
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield buffer
+        finally:
+            buffer.close()
+
+
+def hash_buffer(buffer, course_slug=None):
+    with instrumentation.timer("hash", n_bytes=len(buffer), course=course_slug):
+        return qiniu_etag(buffer)
+
+
+def hash_file(file_path, course_slug=None):
+    """
+    Return the qiniu etag of ``file_path``.
+    """
+    with map_file(file_path) as buffer:
+        return hash_buffer(buffer, course_slug)
 
 
 class CourseraPage(object):
@@ -263,14 +864,23 @@ def local_path_to_url(course_slug, local_path, ext=None):
     if ext:
         local_path = os.path.splitext(local_path)[0] + ext
 
+    return asset_url_resolver.resolve(course_slug, local_path)
+
+
+def _local_path_to_url(course_slug, local_path):
     if sys.platform.startswith("win"):
         assert local_path.startswith(LOCAL_PATH_PREFIX), local_path
 
         striped_local_path = local_path[len(LOCAL_PATH_PREFIX):]
         striped_local_path = striped_local_path.replace("\\", "/")
+    elif not upload_to_qiniu:
+        # Nothing is uploaded, the URL is the path the file would have in the
+        # bucket.
+        assert os.path.isfile(os.path.join(os.getcwd(), local_path))
+        striped_local_path = local_path
     else:
         assert os.path.isfile(os.path.join(os.getcwd(), local_path))
-        striped_local_path = upload_resource_to_qiniu(course_slug, local_path)
+        striped_local_path = upload_scheduler.submit(course_slug, local_path).result()
     assert not striped_local_path.startswith("/")
 
     # Remove in_bucket_prefix from url
@@ -279,11 +889,157 @@ def local_path_to_url(course_slug, local_path, ext=None):
     return striped_local_path
 
 
-def convert_video_page(item):
-    with database:
-        video_assets = ItemVideoAsset.select().join(Item).where(Item.item_id == item.item_id)
+class AssetURLResolver(object):
+    """
+    Map (course_slug, local path) to the URL of the file for the whole run,
+    so that each file is checked and uploaded once however many pages link
+    to it. Concurrent requests for a file which is being resolved wait for
+    that resolution. A failed resolution is not remembered.
+    """
+    def __init__(self):
+        self._futures = {}
+        self._signatures = {}
+        self._lock = threading.Lock()
+        self.n_hits = 0
+        self.n_waits = 0
+        self.n_misses = 0
+
+    def resolve(self, course_slug, local_path):
+        key = (course_slug, os.path.normpath(local_path))
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None:
+                self.n_misses += 1
+                future = self._futures[key] = Future()
+                self._signatures[key] = self._get_signature(local_path)
+                owner = True
+            else:
+                self.n_hits += 1
+                if not future.done():
+                    self.n_waits += 1
+                owner = False
+
+        instrumentation.add("url_miss" if owner else "url_hit", course=course_slug)
+        if owner:
+            try:
+                future.set_result(_local_path_to_url(course_slug, local_path))
+            except BaseException as e:
+                with self._lock:
+                    del self._futures[key]
+                future.set_exception(e)
+        return future.result()
+
+    @staticmethod
+    def _get_signature(local_path):
+        try:
+            file_stat = os.stat(local_path)
+        except OSError:
+            return None
+        return file_stat.st_size, file_stat.st_mtime_ns
+
+    def forget_changed(self):
+        """
+        Forget the URLs of the files which changed since they were resolved.
+        """
+        with self._lock:
+            for key, signature in list(self._signatures.items()):
+                future = self._futures.get(key)
+                if future is not None and not future.done():
+                    continue
+                if future is None or self._get_signature(key[1]) != signature:
+                    self._futures.pop(key, None)
+                    del self._signatures[key]
+
+    def write_stats(self):
+        if self.n_misses:
+            sys.stdout.write(
+                "%d asset URLs resolved, %d reused (%d while being resolved).\n"
+                % (self.n_misses, self.n_hits, self.n_waits))
+
+
+asset_url_resolver = AssetURLResolver()
+
+
+ASSET_ID_RE = re.compile(
+    r"""<(?:asset|img)\b[^>]*?\b(?:id|assetid)\s*=\s*["']([^"']+)["']""", re.I)
+
+# Maximum number of parameters in an "IN" query, below SQLite's limit.
+SQLITE_MAX_IN_PARAMS = 500
+
+
+class CourseData(object):
+    """
+    All the rows needed to convert a course, fetched with a fixed number of
+    queries instead of per item or per asset tag. Items are grouped by the
+    slug of their module, video and item assets by item_id, and course assets
+    are looked up by asset_id.
+    """
+    def __init__(self, course_slug):
+        self.course_slug = course_slug
+
+        # In one read transaction, for a consistent view of the course.
+        with database.atomic(), instrumentation.timer("load", course=course_slug):
+            self.course = Course.get(course_slug=course_slug)
+            self.modules = list(
+                Module.select().join(Course).where(Course.course_slug == course_slug))
+            self.references = list(
+                Reference.select().join(Course).where(Course.course_slug == course_slug))
+
+            items = (Item.select(Item, Module)
+                     .join(Module).join(Course)
+                     .where(Course.course_slug == course_slug))
+            video_assets = (ItemVideoAsset.select(ItemVideoAsset, Item)
+                            .join(Item).join(Module).join(Course)
+                            .where(Course.course_slug == course_slug))
+
+            asset_model = ItemAsset.asset.rel_model
+            item_assets = (ItemAsset.select(ItemAsset, Item, asset_model)
+                           .join(Item).join(Module).join(Course)
+                           .switch(ItemAsset).join(asset_model, on=ItemAsset.asset)
+                           .where(Course.course_slug == course_slug))
+
+            self.items = OrderedDict((module.slug, []) for module in self.modules)
+            for item in items:
+                self.items.setdefault(item.module.slug, []).append(item)
+
+            self.video_assets = {}
+            for video_asset in video_assets:
+                self.video_assets.setdefault(video_asset.item.item_id, []).append(video_asset)
+
+            self.item_assets = {}
+            for item_asset in item_assets:
+                self.item_assets.setdefault(item_asset.item.item_id, []).append(item_asset.asset)
+
+            asset_ids = set()
+            for module_items in self.items.values():
+                for item in module_items:
+                    asset_ids.update(ASSET_ID_RE.findall(item.content or ""))
+            for reference in self.references:
+                asset_ids.update(ASSET_ID_RE.findall(reference.content or ""))
+
+            self.course_assets = {}
+            asset_ids = sorted(asset_ids)
+            for i in range(0, len(asset_ids), SQLITE_MAX_IN_PARAMS):
+                for course_asset in CourseAsset.select().where(
+                        CourseAsset.asset_id.in_(asset_ids[i:i + SQLITE_MAX_IN_PARAMS])):
+                    self.course_assets.setdefault(course_asset.asset_id, course_asset)
+
+    def get_course_asset(self, asset_id):
+        """
+        Return the CourseAsset with ``asset_id``, or None if it does not exist.
+        """
+        if asset_id not in self.course_assets:
+            # Not found by ASSET_ID_RE, e.g., an unquoted attribute.
+            try:
+                self.course_assets[asset_id] = CourseAsset.get(asset_id=asset_id)
+            except CourseAsset.DoesNotExist:
+                self.course_assets[asset_id] = None
+        return self.course_assets[asset_id]
+
 
-    course_slug = item.lesson.module.course.course_slug
+def convert_video_page(item, course_data):
+    video_assets = course_data.video_assets.get(item.item_id, [])
+    course_slug = course_data.course_slug
 
     assert len(video_assets) <= 1
 
@@ -294,10 +1050,12 @@ def convert_video_page(item):
     url = local_path_to_url(course_slug, video_asset.saved_path)
     sub_list = [lang.strip() for lang in video_asset.subtitles.split(",") if lang.endswith(".vtt")]
     langs = []
+    subtitle_uploads = []
     for lang in ['zh-CN', 'zh-TW', 'en']:
         if lang + ".vtt" in sub_list:
             langs.append(lang)
-            upload_resource_to_qiniu(course_slug, replace_ext(video_asset.saved_path, ext=".%s.vtt" % lang))
+            subtitle_uploads.append(upload_scheduler.submit(
+                course_slug, replace_ext(video_asset.saved_path, ext=".%s.vtt" % lang)))
 
     for sub in sub_list:
         lang, _ = os.path.splitext(sub)
@@ -306,28 +1064,100 @@ def convert_video_page(item):
 
     video = CourseraVideo(url=url, langs=langs)
 
-    jinja_env = jinja2.Environment()
-    template = jinja_env.from_string(video_template)
-    video_html = template.render(video=video)
+    video_html = render_template("video", video=video)
 
     resource_html = ""
-    item_assets = ItemAsset.select().join(Item).where(Item.item_id == item.item_id)
+    item_assets = course_data.item_assets.get(item.item_id, [])
     if len(item_assets):
-        template = jinja_env.from_string(resource_template)
-
         assets = []
-        for item_asset in item_assets:
-            if item_asset.asset.saved_path:
-                asset = item_asset.asset
+        for asset in item_assets:
+            if asset.saved_path:
                 assets.append(CourseraItemAsset(asset.asset_type, asset.name, course_slug, asset.saved_path))
 
-        resource_html = template.render(assets=assets)
+        resource_html = render_template("resource", assets=assets)
 
     output = "\n".join([video_html, resource_html])
 
+    for future in subtitle_uploads:
+        future.result()
+
     return output
 
 
+def get_item_asset_paths(item, course_data):
+    """
+    Return the local paths of the files a page (an item or a reference) links
+    to.
+    """
+    paths = []
+    if getattr(item, "type_name", None) == "lecture":
+        for video_asset in course_data.video_assets.get(item.item_id, []):
+            paths.append(video_asset.saved_path)
+            for sub in video_asset.subtitles.split(","):
+                sub = sub.strip()
+                if sub.endswith(".vtt"):
+                    paths.append(replace_ext(video_asset.saved_path, ext=".%s" % sub))
+        for asset in course_data.item_assets.get(item.item_id, []):
+            if asset.saved_path:
+                paths.append(asset.saved_path)
+    else:
+        for asset_id in sorted(set(ASSET_ID_RE.findall(item.content or ""))):
+            course_asset = course_data.course_assets.get(asset_id)
+            if course_asset is not None and course_asset.saved_path:
+                paths.append(course_asset.saved_path)
+    return paths
+
+
+def get_file_signature(file_path):
+    """
+    Return what identifies the published version of a file: the key it was
+    uploaded with, or its size and mtime if it is not in the manifest.
+    """
+    if not os.path.isfile(file_path):
+        return None
+    entry = get_manifest_entry(file_path)
+    if entry is not None:
+        return [entry.etag, entry.bucket, entry.key]
+    file_stat = os.stat(file_path)
+    return [file_stat.st_size, file_stat.st_mtime_ns]
+
+
+def get_pages_fingerprint(course_data, items, *flow_attrs):
+    """
+    Return the fingerprint of everything a flow is generated from: the
+    templates, the widths images are resized to, the attributes of the
+    flow, the rows of its pages and the files they link to.
+    """
+    data = [get_templates_fingerprint(), IMAGE_WIDTHS, flow_attrs]
+    for item in items:
+        item_data = [getattr(item, name, None)
+                     for name in ("item_id", "slug", "name", "type_name", "content")]
+        if getattr(item, "type_name", None) == "lecture":
+            item_data.append([
+                [video_asset.saved_path, video_asset.subtitles]
+                for video_asset in course_data.video_assets.get(item.item_id, [])])
+            item_data.append([
+                [asset.asset_type, asset.name]
+                for asset in course_data.item_assets.get(item.item_id, [])])
+        item_data.append([
+            [path, get_file_signature(path)]
+            for path in get_item_asset_paths(item, course_data)])
+        data.append(item_data)
+    return get_fingerprint(data)
+
+
+def prefetch_video_page_uploads(item, course_data):
+    """
+    Enqueue the uploads a video page will need, so that they run concurrently
+    while the pages before it are converted.
+    """
+    if not upload_to_qiniu:
+        return
+
+    paths = get_item_asset_paths(item, course_data)
+    upload_scheduler.submit_many(course_data.course_slug, [path for path in paths if os.path.isfile(path)])
+
+
 COLON_START = re.compile(r'\n\s*:', re.M)
 
 
@@ -336,194 +1166,1720 @@ def avoid_colon_at_beginning(s):
     return s
 
 
-def convert_normal_page(item):
-    content = avoid_colon_at_beginning(item.content)
-    soup = BeautifulSoup(content)
+HEADER_NAMES = ["h1", "h2", "h3"]
 
-    try:
-        course_slug = item.lesson.module.course.course_slug
-    except AttributeError:
-        # reference asset
-        course_slug = item.course.course_slug
+# The tags convert_normal_page rewrites.
+PAGE_TAG_NAMES = HEADER_NAMES + ["asset", "img"]
 
-    # remove header tag if its content is the same with the title.
-    for header_name in ["h1", "h2", "h3"]:
-        header_tags = soup.find(header_name)
-        if header_tags:
-            try:
-                header_tag_content = " ".join([str(content) for content in header_tags.contents])
-            except Exception as e:
-                raise e
-            header_tag_content = header_tag_content.replace("\n", " ").replace("  ", " ")
-            header_tag_content = header_tag_content.strip()
-            if header_tag_content == item.name:
-                header_tags.decompose()
-
-    for asset_tag in soup.find_all(name="asset"):
-        asset_tag.name = "a"
-        asset_type = asset_tag["assettype"]
-        asset_extension = asset_tag["extension"]
-        asset_id = asset_tag["id"]
-        asset_name = asset_tag["name"]
-        with database:
-            try:
-                db_asset = CourseAsset.get(asset_id=asset_id)
-            except CourseAsset.DoesNotExist:
-                continue
-        url = local_path_to_url(course_slug, db_asset.saved_path)
-        asset_tag["href"] = url
-        asset_tag["target"] = "_blank"
 
-        ext = ".%s" % asset_extension.lstrip(".")
-        if not asset_name.endswith(ext):
-            asset_name += "(%s)" % asset_extension
+def prepare_normal_page(item, course_data):
+    """
+    Parse a page and enqueue the uploads of the assets it links to. Return a
+    function which finishes converting the page once they are uploaded.
+    """
+    content = avoid_colon_at_beginning(item.content)
+    soup = BeautifulSoup(content)
 
-        asset_tag.insert(0, NavigableString(asset_name))
+    course_slug = course_data.course_slug
+
+    # Collect the first header of each level, the assets and the images in a
+    # single walk over the tree.
+    headers = {}
+    asset_tags = []
+    img_tags = []
+    for tag in soup.find_all(PAGE_TAG_NAMES):
+        if tag.name == "asset":
+            asset_tags.append(tag)
+        elif tag.name == "img":
+            img_tags.append(tag)
+        elif tag.name not in headers:
+            headers[tag.name] = tag
 
-    for asset_tag in soup.find_all(name="img"):
+    # remove header tag if its content is the same with the title.
+    removed = set()
+    for header_name in HEADER_NAMES:
+        header_tag = headers.get(header_name)
+        if header_tag is not None and id(header_tag) in removed:
+            # It was inside a removed header, the next one is the first now.
+            header_tag = soup.find(header_name)
+        if header_tag is None:
+            continue
+        header_tag_content = " ".join([str(content) for content in header_tag.contents])
+        header_tag_content = header_tag_content.replace("\n", " ").replace("  ", " ")
+        header_tag_content = header_tag_content.strip()
+        if header_tag_content == item.name:
+            removed.add(id(header_tag))
+            removed.update(id(tag) for tag in header_tag.find_all(PAGE_TAG_NAMES))
+            header_tag.decompose()
+
+    if removed:
+        asset_tags = [tag for tag in asset_tags if id(tag) not in removed]
+        img_tags = [tag for tag in img_tags if id(tag) not in removed]
+
+    # Look up all the assets and enqueue their uploads first, so that they
+    # are uploaded concurrently.
+    assets = []
+    for asset_tag in asset_tags:
+        db_asset = course_data.get_course_asset(asset_tag["id"])
+        assets.append((asset_tag, db_asset))
+
+    images = []
+    for asset_tag in img_tags:
         asset_tag['class'] = asset_tag.get('class', []) + ['img-responsive']
         if not asset_tag.has_attr("assetid"):
             continue
-        asset_id = asset_tag["assetid"]
-        with database:
-            try:
-                db_asset = CourseAsset.get(asset_id=asset_id)
-            except CourseAsset.DoesNotExist:
+        db_asset = course_data.get_course_asset(asset_tag["assetid"])
+        if db_asset is None:
+            continue
+        images.append((asset_tag, db_asset))
+
+    if upload_to_qiniu:
+        upload_scheduler.submit_many(
+            course_slug,
+            [db_asset.saved_path for _, db_asset in assets + images if db_asset is not None])
+
+    def finish():
+        for asset_tag, db_asset in assets:
+            asset_tag.name = "a"
+            asset_type = asset_tag["assettype"]
+            asset_extension = asset_tag["extension"]
+            asset_name = asset_tag["name"]
+            if db_asset is None:
                 continue
-        url = local_path_to_url(course_slug, db_asset.saved_path)
-        asset_tag["src"] = url
+            url = local_path_to_url(course_slug, db_asset.saved_path)
+            asset_tag["href"] = url
+            asset_tag["target"] = "_blank"
 
-    return html.unescape(soup.decode_contents()).replace("$$", "$")
+            ext = ".%s" % asset_extension.lstrip(".")
+            if not asset_name.endswith(ext):
+                asset_name += "(%s)" % asset_extension
 
+            asset_tag.insert(0, NavigableString(asset_name))
 
-def generate_flow(module_slug, ordinal):
-    with database:
-        module = Module.get(slug=module_slug)
-        items = Item.select().join(Module).where(Module.slug == module_slug)
+        for asset_tag, db_asset in images:
+            url = local_path_to_url(course_slug, db_asset.saved_path)
+            asset_tag["src"] = url
 
-    course_slug = module.course.course_slug
-    slug = "%s_%s_%s" % (course_slug, str(ordinal), module_slug)
+        return html.unescape(soup.decode_contents()).replace("$$", "$")
 
-    flow_id = slug.replace("_", "-")
-    yaml_path = "%s.yml" % flow_id
-    file_name = os.path.join(os.getcwd(), yaml_path)
+    return finish
 
-    pages = []
-    for i, item in enumerate(items):
-        if item.type_name == "lecture":
-            content = convert_video_page(item)
-        else:
-            if not item.content:
-                continue
-            content = convert_normal_page(item)
 
-        if content:
-            pages.append(CourseraPage(id="%s_%s" % (item.slug, str(i+1)), title=item.name, content=content))
+def convert_normal_page(item, course_data):
+    return prepare_normal_page(item, course_data)()
 
-    jinja_env = jinja2.Environment()
-    template = jinja_env.from_string(flow_template)
-    output = template.render(module_name=module.name, module_description=module.description, pages=pages)
 
-    if sys.platform.startswith("win"):
-        with open(file_name, "w", encoding="utf-8") as f:
-            f.write(output)
+def prepare_video_page(item, course_data):
+    """
+    The counterpart of :func:`prepare_normal_page` for video pages.
+    """
+    prefetch_video_page_uploads(item, course_data)
+    return partial(convert_video_page, item, course_data)
 
-    upload_to_dropbox("/" + os.path.join(course_slug, "flows", yaml_path), output.encode())
-    sys.stdout.write("%s uploaded to Dropbox.\n" % flow_id)
-    return flow_id
 
+class CourseraFlow(object):
+    def __init__(self, name, flow_id, description=""):
+        self.name = name
+        self.flow_id = flow_id
+        self.description = description
 
-def generate_reference_flow(course_slug, references, ordinal):
-    slug = "%s_%s_resource" % (course_slug, str(ordinal))
 
+class FlowJob(object):
+    """
+    A flow on its way through the stages of its generation.
+    """
+    def __init__(self, course_data, flow, items, flow_attrs, template_context,
+                 is_reference=False):
+        self.course_data = course_data
+        self.flow = flow
+        self.flow_id = flow.flow_id
+        self.items = items
+        self.flow_attrs = flow_attrs
+        self.template_context = template_context
+        self.is_reference = is_reference
+
+        yaml_path = "%s.yml" % self.flow_id
+        self.file_name = os.path.join(os.getcwd(), yaml_path)
+        self.dropbox_path = "/" + os.path.join(course_data.course_slug, "flows", yaml_path)
+
+        # None when the flow is up to date and does not need to be rebuilt.
+        self.reason = None
+        self.pages = None
+        self.asset_paths = []
+        self.output = None
+
+        # What the flow costs in memory while it is being generated, roughly.
+        self.weight = sum(len(item.content or "") for item in items)
+
+
+def get_flow_job(course_data, module, ordinal):
+    slug = "%s_%s_%s" % (course_data.course_slug, str(ordinal), module.slug)
     flow_id = slug.replace("_", "-")
-    yaml_path = "%s.yml" % flow_id
-    file_name = os.path.join(os.getcwd(), yaml_path)
+    return FlowJob(
+        course_data, CourseraFlow(module.name, flow_id, description=module.description),
+        course_data.items[module.slug], (flow_id, module.name, module.description),
+        dict(module_name=module.name, module_description=module.description))
 
-    pages = []
-    for i, item in enumerate(references):
-        if not item.content:
-            continue
-        content = convert_normal_page(item)
 
+def get_reference_flow_job(course_data, ordinal):
+    slug = "%s_%s_resource" % (course_data.course_slug, str(ordinal))
+    flow_id = slug.replace("_", "-")
+    return FlowJob(
+        course_data, CourseraFlow("Resources", flow_id), course_data.references,
+        (flow_id,), dict(module_name="Resources"), is_reference=True)
+
+
+def convert_flow(job):
+    """
+    Check whether the flow needs to be rebuilt and, if so, parse its pages
+    and enqueue the uploads of their assets.
+    """
+    job.reason = get_rebuild_reason(
+        job.dropbox_path,
+        get_pages_fingerprint(job.course_data, job.items, *job.flow_attrs))
+    if job.reason is None:
+        job.reason = get_bundle_rebuild_reason(job.dropbox_path)
+    if job.reason is None:
+        return job
+
+    job.pages = []
+    for i, item in enumerate(job.items):
+        with instrumentation.timer("prepare_page", course=job.course_data.course_slug,
+                                   flow=job.flow_id, item=item.slug):
+            if getattr(item, "type_name", None) == "lecture":
+                finish = prepare_video_page(item, job.course_data)
+            else:
+                if not item.content:
+                    continue
+                finish = prepare_normal_page(item, job.course_data)
+        job.pages.append((i, item, finish))
+        job.asset_paths.extend(get_item_asset_paths(item, job.course_data))
+    return job
+
+
+def iter_flow_pages(job, prepared_pages):
+    for i, item, finish in prepared_pages:
+        with instrumentation.timer("finish_page", course=job.course_data.course_slug,
+                                   flow=job.flow_id, item=item.slug):
+            content = finish()
         if content:
-            pages.append(CourseraPage(id="%s_%s" % (item.slug, str(i+1)),
-                                      title=item.name, content=content))
+            yield CourseraPage(id="%s_%s" % (item.slug, str(i+1)),
+                               title=item.name, content=content)
 
-    jinja_env = jinja2.Environment()
-    template = jinja_env.from_string(flow_template)
-    output = template.render(module_name="Resources", pages=pages)
 
-    if sys.platform.startswith("win"):
-        with open(file_name, "w", encoding="utf-8") as f:
-            f.write(output)
+def finish_flow_pages(job):
+    """
+    Wait for the uploads of the assets of the flow. Its pages are finished
+    one by one while it is rendered.
+    """
+    if job.reason is None:
+        return job
 
-    upload_to_dropbox("/" + os.path.join(course_slug, "flows", yaml_path), output.encode())
-    sys.stdout.write("---%s uploaded to Dropbox.---\n" % flow_id)
-    return flow_id
+    upload_scheduler.wait(job.asset_paths)
+    job.pages = iter_flow_pages(job, job.pages)
+    return job
 
 
-class CourseraFlow(object):
-    def __init__(self, name, flow_id, description=""):
-        self.name = name
-        self.flow_id = flow_id
-        self.description = description
+def render_flow(job):
+    if job.reason is None:
+        return job
 
+    job.output = render_template_to_file("flow", pages=job.pages, **job.template_context)
+    job.pages = None
+    return job
 
-def generate_yamls(course_slug):
-    with database:
-        course = Course.get(course_slug=course_slug)
-        modules = Module.select().join(Course).where(Course.course_slug == course_slug)
-        references = Reference.select().join(Course).where(Course.course_slug == course_slug)
-
-    flows = []
-    ordinal = 0
-    for i, module in enumerate(modules):
-        flow_id = generate_flow(module.slug, i + 1)
-        flows.append(CourseraFlow(module.name, flow_id, description=module.description))
-        ordinal = i + 1
-
-    if references:
-        flow_id = generate_reference_flow(course.course_slug, references, ordinal+1)
-        flows.append(CourseraFlow("Resources", flow_id))
 
-    def generate_course_yml(template_name, yaml_path):
-        jinja_env = jinja2.Environment()
-        template = jinja_env.from_string(template_name)
-        output = template.render(course=course, flows=flows)
+def publish_flow(job):
+    if job.reason is None:
+        record_build(job.dropbox_path, job.reason)
+        return job
 
-        if sys.platform.startswith("win"):
-            with open(yaml_path, "w", encoding="utf-8") as f:
-                f.write(output)
-                return
+    # The uploads have updated the manifest, fingerprint the published state.
+    fingerprint = get_pages_fingerprint(job.course_data, job.items, *job.flow_attrs)
+    publish_file(job.dropbox_path, job.output, job.file_name,
+                 on_published=partial(store_fingerprint, job.dropbox_path, fingerprint))
+    if job.is_reference:
+        sys.stdout.write("---%s uploaded to Dropbox.---\n" % job.flow_id)
+    else:
+        sys.stdout.write("%s uploaded to Dropbox.\n" % job.flow_id)
+    record_build(job.dropbox_path, job.reason)
+    job.output = None
+    return job
+
+
+FLOW_STAGES = [
+    ("convert", convert_flow),
+    ("upload", finish_flow_pages),
+    ("render", render_flow),
+    ("publish", publish_flow),
+]
+
+
+def run_flow_job(job):
+    for _, stage in FLOW_STAGES:
+        job = stage(job)
+    return job.flow_id
+
+
+def generate_flow(course_data, module, ordinal):
+    return run_flow_job(get_flow_job(course_data, module, ordinal))
+
+
+def generate_reference_flow(course_data, ordinal):
+    return run_flow_job(get_reference_flow_job(course_data, ordinal))
 
-        dropbox_path = "/" + os.path.join(course_slug, yaml_path)
-        upload_to_dropbox(dropbox_path, output.encode())
 
-    # for embedded chunk
-    yaml_path = "%s_course_chunks.yml" % course_slug.replace("_", "-")
-    template_name = course_chunks_template_embed
-    generate_course_yml(template_name, yaml_path)
+def get_course_yml_paths(course_slug):
+    """
+    Return the (template name, path) of the course chunk files of a course.
+    """
+    return [
+        # for embedded chunk
+        ("course_chunks_embed", "%s_course_chunks.yml" % course_slug.replace("_", "-")),
+        # for single course
+        ("course_chunks_single", "course.yml"),
+    ]
 
-    # for single course
-    yaml_path = "course.yml"
-    template_name = course_chunks_template_single
-    generate_course_yml(template_name, yaml_path)
 
+def get_course_yml_fingerprint(course, flows, template_name):
+    return get_fingerprint([
+        get_templates_fingerprint(), template_name, course.course_name_string,
+        [(flow.name, flow.flow_id, flow.description) for flow in flows]])
+
+
+def generate_course_ymls(course, flows):
+    course_slug = course.course_slug
+
+    def generate_course_yml(template_name, yaml_path):
+        dropbox_path = "/" + os.path.join(course_slug, yaml_path)
+        fingerprint = get_course_yml_fingerprint(course, flows, template_name)
+        reason = get_rebuild_reason(dropbox_path, fingerprint)
+        if reason is None:
+            reason = get_bundle_rebuild_reason(dropbox_path)
+        if reason is None:
+            record_build(dropbox_path, reason)
+            return
+
+        output = render_template_to_file(template_name, course=course, flows=flows)
+        publish_file(dropbox_path, output, yaml_path,
+                     on_published=partial(store_fingerprint, dropbox_path, fingerprint))
+        record_build(dropbox_path, reason)
+
+    for template_name, yaml_path in get_course_yml_paths(course_slug):
+        generate_course_yml(template_name, yaml_path)
+
+    flush_dropbox()
+    if BUNDLE_DIR:
+        commit_bundle(course_slug)
     sys.stdout.write("--------------Done!-----------------\n")
 
 
-def upload_to_dropbox(file_name, file_content):
+def get_course_flow_jobs(course_data):
+    jobs = [get_flow_job(course_data, module, i + 1)
+            for i, module in enumerate(course_data.modules)]
+    if course_data.references:
+        jobs.append(get_reference_flow_job(course_data, len(course_data.modules) + 1))
+    return jobs
+
+
+def generate_yamls(course_slug):
+    if BUNDLE_DIR:
+        open_bundle(course_slug)
+    course_data = CourseData(course_slug)
+
+    jobs = get_course_flow_jobs(course_data)
+    for job in jobs:
+        run_flow_job(job)
+
+    generate_course_ymls(course_data.course, [job.flow for job in jobs])
+
+
+# Flows waiting between two stages of the pipeline, and the size of the pages
+# of the flows being generated at once. A flow larger than that still goes
+# through, alone.
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", "2"))
+PIPELINE_MAX_INFLIGHT_BYTES = int(
+    os.environ.get("PIPELINE_MAX_INFLIGHT_BYTES", str(64 * 1024 * 1024)))
+
+
+class PipelineStage(object):
+    """
+    A stage of a :class:`Pipeline`, and how its thread spent its time.
+    """
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+        self.n_items = 0
+        self.busy_time = 0.
+        self.idle_time = 0.
+        self.blocked_time = 0.
+
+
+class Pipeline(object):
+    """
+    Run items through stages, each in its own thread, connected by bounded
+    queues, so that one item is converted while the previous one is uploaded
+    and the one before is published.
+
+    The items are fed from the calling thread. Their ``weight`` is admitted
+    against ``max_inflight_bytes`` and released once the last stage is done
+    with them.
+    """
+    _done = object()
+
+    def __init__(self, stages, queue_size=PIPELINE_QUEUE_SIZE,
+                 max_inflight_bytes=PIPELINE_MAX_INFLIGHT_BYTES):
+        self.feed = PipelineStage("load", None)
+        self.stages = [PipelineStage(name, func) for name, func in stages]
+        self.queue_size = queue_size
+        self.max_inflight_bytes = max_inflight_bytes
+        self.inflight_bytes = 0
+        self.peak_inflight_bytes = 0
+        self.condition = threading.Condition()
+        self.error = None
+
+    def _admit(self, weight):
+        with self.condition:
+            while (self.error is None and self.inflight_bytes
+                   and self.inflight_bytes + weight > self.max_inflight_bytes):
+                self.condition.wait()
+            self.inflight_bytes += weight
+            self.peak_inflight_bytes = max(self.peak_inflight_bytes, self.inflight_bytes)
+
+    def _release(self, weight):
+        with self.condition:
+            self.inflight_bytes -= weight
+            self.condition.notify_all()
+
+    def _fail(self, error):
+        with self.condition:
+            if self.error is None:
+                self.error = error
+            self.condition.notify_all()
+
+    def _run_stage(self, stage, in_queue, out_queue):
+        while True:
+            start = time.time()
+            item = in_queue.get()
+            stage.idle_time += time.time() - start
+            if item is self._done:
+                break
+
+            # After a failure, the items are only drained, so that no
+            # thread stays blocked.
+            if self.error is None:
+                start = time.time()
+                try:
+                    item = stage.func(item)
+                except BaseException as e:
+                    self._fail(e)
+                stage.busy_time += time.time() - start
+                stage.n_items += 1
+
+            if self.error is not None or out_queue is None:
+                self._release(getattr(item, "weight", 0))
+                continue
+
+            start = time.time()
+            out_queue.put(item)
+            stage.blocked_time += time.time() - start
+
+        if out_queue is not None:
+            out_queue.put(self._done)
+
+    def run(self, items):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        threads = []
+        for i, stage in enumerate(self.stages):
+            out_queue = queues[i + 1] if i + 1 < len(queues) else None
+            thread = threading.Thread(
+                target=self._run_stage, args=(stage, queues[i], out_queue),
+                name="pipeline-%s" % stage.name)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        items = iter(items)
+        try:
+            while self.error is None:
+                start = time.time()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                finally:
+                    self.feed.busy_time += time.time() - start
+
+                start = time.time()
+                weight = getattr(item, "weight", 0)
+                self._admit(weight)
+                if self.error is not None:
+                    self._release(weight)
+                    break
+                queues[0].put(item)
+                self.feed.blocked_time += time.time() - start
+                self.feed.n_items += 1
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            queues[0].put(self._done)
+            for thread in threads:
+                thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def write_stats(self):
+        for stage in [self.feed] + self.stages:
+            sys.stdout.write(
+                "Pipeline %s: %d items, busy %.1fs, idle %.1fs, blocked %.1fs\n"
+                % (stage.name, stage.n_items, stage.busy_time, stage.idle_time,
+                   stage.blocked_time))
+        sys.stdout.write("Pipeline peak in flight: %d bytes\n" % self.peak_inflight_bytes)
+
+
+class CourseEnd(object):
+    """
+    Marks the end of the flows of a course in the pipeline, after which its
+    course ymls are generated.
+    """
+    weight = 0
+
+    def __init__(self, course, flows):
+        self.course = course
+        self.flows = flows
+
+
+def iter_flow_jobs(course_slug_list):
+    for course_slug in course_slug_list:
+        if BUNDLE_DIR:
+            open_bundle(course_slug)
+        course_data = CourseData(course_slug)
+        jobs = get_course_flow_jobs(course_data)
+        for job in jobs:
+            yield job
+        yield CourseEnd(course_data.course, [job.flow for job in jobs])
+
+
+def flow_stage(func):
+    """
+    Apply a stage of the generation of flows to the flows only.
+    """
+    def stage(item):
+        if isinstance(item, FlowJob):
+            return func(item)
+        return item
+    return stage
+
+
+def publish_stage(item):
+    if isinstance(item, CourseEnd):
+        generate_course_ymls(item.course, item.flows)
+        return item
+    return publish_flow(item)
+
+
+def generate_all_yamls(course_slug_list):
+    """
+    Generate the flows of all the courses through a :class:`Pipeline` of
+    the stages of :data:`FLOW_STAGES`.
+    """
+    stages = [(name, flow_stage(func)) for name, func in FLOW_STAGES[:-1]]
+    stages.append((FLOW_STAGES[-1][0], publish_stage))
+    pipeline = Pipeline(stages)
+    try:
+        pipeline.run(iter_flow_jobs(course_slug_list))
+    finally:
+        pipeline.write_stats()
+
+
+def profile_course(course_slug, profiler="cprofile"):
+    """
+    Generate the flows of a single course in this thread under a profiler,
+    and write the profile to profile-<course_slug>.prof (cProfile, for pstats
+    or snakeviz) or .html (pyinstrument). Uploads run in other threads and
+    only show as waits.
+    """
+    if profiler == "pyinstrument":
+        from pyinstrument import Profiler
+        profile_path = "profile-%s.html" % course_slug
+        profile = Profiler()
+        profile.start()
+        try:
+            generate_yamls(course_slug)
+        finally:
+            profile.stop()
+            with open(profile_path, "w", encoding="utf-8") as f:
+                f.write(profile.output_html())
+    else:
+        import cProfile
+        profile_path = "profile-%s.prof" % course_slug
+        profile = cProfile.Profile()
+        try:
+            profile.runcall(generate_yamls, course_slug)
+        finally:
+            profile.dump_stats(profile_path)
+    sys.stdout.write("Profile written to %s.\n" % profile_path)
+
+
+def _init_flow_worker(force_verify, incremental, upload_workers, bundle_dir,
+                      bucket_index_state):
+    global FORCE_VERIFY, INCREMENTAL, BUNDLE_DIR
+    FORCE_VERIFY = force_verify
+    INCREMENTAL = incremental
+    BUNDLE_DIR = bundle_dir
+    upload_scheduler.max_workers = upload_workers
+    bucket_index.set_state(bucket_index_state)
+
+
+# The course of the last job run by this worker.
+_worker_course_data = None
+
+
+def _run_flow_job(job):
+    """
+    Generate one flow in a worker process of :func:`generate_yamls_parallel`.
+    """
+    global _worker_course_data
+    course_slug, ordinal, is_reference = job
+
+    if _worker_course_data is None or _worker_course_data.course_slug != course_slug:
+        _worker_course_data = CourseData(course_slug)
+    course_data = _worker_course_data
+
+    del build_summary[:]
+    if is_reference:
+        flow_id = generate_reference_flow(course_data, ordinal)
+    else:
+        flow_id = generate_flow(course_data, course_data.modules[ordinal - 1], ordinal)
+    flush_dropbox()
+    return flow_id, list(build_summary), instrumentation.pop()
+
+
+def generate_yamls_parallel(course_slug_list, jobs):
+    """
+    Generate the flows of all the courses in ``jobs`` worker processes, each
+    with its own database connections. The course chunk files of a course are
+    generated once all its flows are done, with the flows in the same order
+    as :func:`generate_yamls`.
+    """
+    courses = []
+    flow_jobs = []
+    with database.atomic():
+        for course_slug in course_slug_list:
+            course = Course.get(course_slug=course_slug)
+            modules = list(
+                Module.select().join(Course).where(Course.course_slug == course_slug))
+            has_references = (Reference.select().join(Course)
+                              .where(Course.course_slug == course_slug).exists())
+            courses.append((course, modules, has_references))
+
+            for i, module in enumerate(modules):
+                flow_jobs.append((course_slug, i + 1, False))
+            if has_references:
+                flow_jobs.append((course_slug, len(modules) + 1, True))
+
+    # The workers write to the staging directories of the bundles.
+    if BUNDLE_DIR:
+        for course_slug in course_slug_list:
+            open_bundle(course_slug)
+
+    # The buckets are listed before any worker uploads, so that all the
+    # workers deduplicate against the same files.
+    if upload_to_qiniu:
+        for course_slug in course_slug_list:
+            for bucket_name in [QINIU_BUCKET_NAME, get_video_bucket_name()]:
+                bucket_index.load(bucket_name, course_slug)
+
+    # Spawned rather than forked workers, which would share the connections
+    # of this process.
+    pool = multiprocessing.get_context("spawn").Pool(
+        jobs, initializer=_init_flow_worker,
+        initargs=(FORCE_VERIFY, INCREMENTAL, upload_scheduler.max_workers, BUNDLE_DIR,
+                  bucket_index.get_state()))
+    try:
+        results = pool.imap(_run_flow_job, flow_jobs, chunksize=1)
+        for course, modules, has_references in courses:
+            flows = []
+            for module in modules:
+                flow_id, summary, stats = next(results)
+                build_summary.extend(summary)
+                instrumentation.merge(stats)
+                flows.append(CourseraFlow(module.name, flow_id, description=module.description))
+            if has_references:
+                flow_id, summary, stats = next(results)
+                build_summary.extend(summary)
+                instrumentation.merge(stats)
+                flows.append(CourseraFlow("Resources", flow_id))
+
+            generate_course_ymls(course, flows)
+    finally:
+        pool.close()
+        pool.join()
+
+
+DROPBOX_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Number of files committed in one upload session batch (at most 1000).
+DROPBOX_BATCH_SIZE = 1000
+
+
+def _dropbox_content_hash(blocks):
+    block_hashes = b"".join(hashlib.sha256(block).digest() for block in blocks)
+    return hashlib.sha256(block_hashes).hexdigest()
+
+
+def dropbox_content_hash(data):
+    """
+    Return the Dropbox content hash of ``data``: the SHA-256 of the
+    concatenated SHA-256 of its 4M blocks.
+    """
+    return _dropbox_content_hash(
+        data[i:i + DROPBOX_HASH_BLOCK_SIZE]
+        for i in range(0, len(data), DROPBOX_HASH_BLOCK_SIZE))
+
+
+def dropbox_content_hash_file(f):
+    """
+    Return the Dropbox content hash of the rest of the binary file ``f``,
+    read one block at a time.
+    """
+    return _dropbox_content_hash(iter(partial(f.read, DROPBOX_HASH_BLOCK_SIZE), b""))
+
+
+class TransientError(RuntimeError):
+    """
+    A remote call failed, but may succeed if it is attempted again.
+    ``retry_after`` is how long the service asked to wait, if it did.
+    """
+    def __init__(self, message, retry_after=None):
+        super(TransientError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class RetryPolicy(object):
+    """
+    How the calls to a remote service are attempted: the calls which fail
+    with a :class:`TransientError` or an OSError (the errors of requests are)
+    are attempted again after an exponential backoff with full jitter, the
+    other errors are raised at once.
+
+    A circuit breaker opens after ``breaker_threshold`` failed attempts in a
+    row, the calls then fail with a :class:`CircuitOpenError` without being
+    attempted until ``breaker_cooldown`` seconds passed. The next attempt
+    closes it if it succeeds, and opens it again if it fails.
+    """
+    def __init__(self, name, retries=REMOTE_RETRIES, delay=REMOTE_RETRY_DELAY,
+                 max_delay=REMOTE_MAX_RETRY_DELAY, breaker_threshold=REMOTE_BREAKER_THRESHOLD,
+                 breaker_cooldown=REMOTE_BREAKER_COOLDOWN):
+        self.name = name
+        self.retries = retries
+        self.delay = delay
+        self.max_delay = max_delay
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self._lock = threading.Lock()
+        self._failures_in_a_row = 0
+        self._open_until = 0.
+        self.n_calls = 0
+        self.n_retries = 0
+        self.n_failures = 0
+        self.n_rejected = 0
+        self.wait_time = 0.
+
+    def _before_attempt(self):
+        with self._lock:
+            if self._failures_in_a_row >= self.breaker_threshold and time.time() < self._open_until:
+                self.n_rejected += 1
+                raise CircuitOpenError(
+                    "Not calling %s for %.0f seconds, after %d failures in a row."
+                    % (self.name, self._open_until - time.time(), self._failures_in_a_row))
+
+    def _after_attempt(self, failed):
+        """
+        Record the outcome of an attempt, and return whether the circuit
+        breaker is open.
+        """
+        with self._lock:
+            if not failed:
+                self._failures_in_a_row = 0
+                return False
+            self._failures_in_a_row += 1
+            if self._failures_in_a_row >= self.breaker_threshold:
+                self._open_until = time.time() + self.breaker_cooldown
+                return True
+            return False
+
+    def get_delay(self, attempt, error):
+        delay = random.uniform(0, min(self.max_delay, self.delay * 2 ** (attempt - 1)))
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after:
+            delay = max(delay, retry_after)
+        return delay
+
+    def call(self, func, *args, **kwargs):
+        """
+        Return ``func(*args, **kwargs)``, attempted at most ``retries`` times.
+        """
+        with self._lock:
+            self.n_calls += 1
+        attempt = 0
+        while True:
+            attempt += 1
+            self._before_attempt()
+            try:
+                result = func(*args, **kwargs)
+            except (TransientError, OSError) as e:
+                is_open = self._after_attempt(failed=True)
+                if is_open or attempt >= self.retries:
+                    with self._lock:
+                        self.n_failures += 1
+                    raise
+                delay = self.get_delay(attempt, e)
+                sys.stdout.write(
+                    "Calling %s failed (%s), retrying in %.1f seconds (%d/%d).\n"
+                    % (self.name, e, delay, attempt + 1, self.retries))
+                with self._lock:
+                    self.n_retries += 1
+                    self.wait_time += delay
+                instrumentation.add("retry_wait", delay)
+                time.sleep(delay)
+            else:
+                self._after_attempt(failed=False)
+                return result
+
+    def write_stats(self):
+        if self.n_calls:
+            sys.stdout.write(
+                "%s: %d calls, %d retries (%.1fs waiting), %d failed, %d rejected.\n"
+                % (self.name, self.n_calls, self.n_retries, self.wait_time,
+                   self.n_failures, self.n_rejected))
+
+
+qiniu_retry_policy = RetryPolicy("Qiniu")
+dropbox_retry_policy = RetryPolicy("Dropbox")
+
+
+def check_qiniu_response(info, action):
+    """
+    Raise the error of a failed request to Qiniu, a :class:`TransientError`
+    if it may succeed when it is sent again.
+    """
+    if info.ok():
+        return
+    message = "%s failed: %s" % (action, info.error)
+    if info.need_retry():
+        raise TransientError(message)
+    raise RuntimeError(message)
+
+
+def pool_qiniu_connections():
+    """
+    Keep the connections of the Qiniu SDK alive, in a pool of
+    REMOTE_POOL_SIZE connections per host: it mounts a new adapter on its
+    session before each request otherwise, and so opens new connections.
+    Retries are left to :data:`qiniu_retry_policy`.
+    """
+    from requests.adapters import HTTPAdapter
+    import qiniu.http
+    from qiniu.http import default_client
+
+    qiniu_config.set_default(connection_pool=REMOTE_POOL_SIZE, connection_timeout=REMOTE_TIMEOUT)
+    session = default_client.qn_http_client.session
+    adapter = HTTPAdapter(pool_connections=REMOTE_POOL_SIZE, pool_maxsize=REMOTE_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    qiniu.http._session = session
+    default_client._init_http_adapter = qiniu.http._init_http_adapter = lambda: None
+
+
+class ObjectStore(object):
+    """
+    Where files are uploaded to: the buckets of Qiniu, Dropbox (which has no
+    buckets, ``bucket_name`` is ignored) or a local stand-in.
+
+    Files are described by dicts with the "key", "hash" and "fsize" of the
+    file, "hash" being the content hash of the store (:meth:`hash_data`).
+    """
+    name = None
+
+    def hash_data(self, data):
+        raise NotImplementedError()
+
+    def hash_file(self, f):
+        """
+        Return the hash of the rest of the binary file ``f``.
+        """
+        return self.hash_data(f.read())
+
+    def list(self, bucket_name, prefix=""):
+        """
+        Return the files whose key starts with ``prefix``.
+        """
+        raise NotImplementedError()
+
+    def stat(self, bucket_name, keys):
+        """
+        Return an ordered dict of key -> file, None if the file does not
+        exist or its stat failed.
+        """
+        raise NotImplementedError()
+
+    def put_file(self, bucket_name, key, file_path, progress_handler=None,
+                 upload_progress_recorder=None, buffer=None):
+        """
+        Upload the file at ``file_path`` to ``key``, reading it from
+        ``buffer`` (see :func:`map_file`) if given. Return the uploaded file,
+        None if the upload failed.
+        """
+        raise NotImplementedError()
+
+    def put_data(self, bucket_name, key, data):
+        """
+        Upload ``data`` to ``key``, and return its hash.
+        """
+        raise NotImplementedError()
+
+    def put_many(self, bucket_name, items):
+        """
+        Upload the ``(key, data)`` of ``items``. Return a list of (hash,
+        error) of each of them, hash being None if its upload failed.
+        ``items`` is iterated once, an item being uploaded before the next
+        one is taken, so that the data can be read as it is needed.
+        """
+        results = []
+        for key, data in items:
+            try:
+                results.append((self.put_data(bucket_name, key, data), None))
+            except Exception as e:
+                results.append((None, str(e)))
+        return results
+
+    def put_chunks(self, bucket_name, key, chunks):
+        """
+        Upload the concatenation of the byte strings ``chunks`` to ``key``,
+        and return its hash.
+        """
+        return self.put_data(bucket_name, key, b"".join(chunks))
+
+    def delete(self, bucket_name, keys):
+        """
+        Delete the files, and return an ordered dict of key -> error message,
+        None if the file was deleted.
+        """
+        raise NotImplementedError()
+
+    def find_video_bucket(self, prefix):
+        """
+        Return the name of the bucket videos are uploaded to.
+        """
+        raise NotImplementedError()
+
+
+class QiniuStore(ObjectStore):
+    """
+    The buckets of Qiniu. Stats and deletes are sent in batch requests of at
+    most ``batch_size`` keys.
+    """
+    name = "qiniu"
+
+    def __init__(self, auth, bucket_manager, batch_size=QINIU_BATCH_SIZE):
+        self.auth = auth
+        self.bucket_manager = bucket_manager
+        self.batch_size = batch_size
+
+    def hash_data(self, data):
+        return qiniu_etag(data)
+
+    def list(self, bucket_name, prefix=""):
+        def list_page(marker):
+            ret, eof, info = self.bucket_manager.list(
+                bucket=bucket_name, prefix=prefix, marker=marker)
+            check_qiniu_response(info, "Listing '%s' in %s" % (prefix, bucket_name))
+            return ret, eof
+
+        items = []
+        marker = None
+        while True:
+            ret, eof = qiniu_retry_policy.call(list_page, marker)
+            items.extend(ret.get("items", []))
+            marker = ret.get("marker")
+            if eof or not marker:
+                break
+        return items
+
+    def _batch(self, build_ops, bucket_name, keys):
+        results = OrderedDict()
+        for i in range(0, len(keys), self.batch_size):
+            chunk = keys[i:i + self.batch_size]
+            ret, info = qiniu_retry_policy.call(self._send_batch, build_ops(bucket_name, chunk))
+            if not isinstance(ret, list):
+                # The whole request failed.
+                for key in chunk:
+                    results[key] = {"code": info.status_code, "data": {"error": info.error}}
+                continue
+            for key, result in zip(chunk, ret):
+                results[key] = result
+        return results
+
+    def _send_batch(self, ops):
+        ret, info = self.bucket_manager.batch(ops)
+        if not isinstance(ret, list) and info.need_retry():
+            raise TransientError("Batch request failed: %s" % info.error)
+        return ret, info
+
+    def stat(self, bucket_name, keys):
+        stats = OrderedDict()
+        for key, result in self._batch(build_batch_stat, bucket_name, list(keys)).items():
+            stats[key] = result.get("data") if result.get("code") == 200 else None
+        return stats
+
+    def put_file(self, bucket_name, key, file_path, progress_handler=None,
+                 upload_progress_recorder=None, buffer=None):
+        """
+        Upload a file in a single attempt, see :func:`_upload` for retries.
+        """
+        token = self.auth.upload_token(bucket_name, key, 3600)
+        if buffer is None:
+            ret, info = put_file(token, key, file_path, progress_handler=progress_handler,
+                                 upload_progress_recorder=upload_progress_recorder)
+        elif len(buffer) > QINIU_BLOCK_SIZE:
+            # Like put_file, but from the mapped file.
+            buffer.seek(0)
+            ret, info = put_stream(
+                token, key, buffer, os.path.basename(file_path), len(buffer),
+                progress_handler=progress_handler,
+                upload_progress_recorder=upload_progress_recorder,
+                modify_time=int(os.path.getmtime(file_path)))
+        else:
+            ret, info = put_data(token, key, bytes(buffer), check_crc=True,
+                                 progress_handler=progress_handler,
+                                 fname=os.path.basename(file_path))
+        if ret and "key" in ret:
+            return ret
+        check_qiniu_response(info, "Uploading '%s'" % key)
+        raise TransientError("Uploading '%s' failed: %s" % (key, info.error))
+
+    def put_data(self, bucket_name, key, data):
+        def upload():
+            token = self.auth.upload_token(bucket_name, key, 3600)
+            ret, info = put_data(token, key, data)
+            if ret and "hash" in ret:
+                return ret["hash"]
+            check_qiniu_response(info, "Uploading '%s'" % key)
+            raise TransientError("Uploading '%s' failed: %s" % (key, info.error))
+
+        return qiniu_retry_policy.call(upload)
+
+    def delete(self, bucket_name, keys):
+        report = OrderedDict()
+        for key, result in self._batch(build_batch_delete, bucket_name, list(keys)).items():
+            if result.get("code") == 200:
+                report[key] = None
+            else:
+                report[key] = (result.get("data") or {}).get("error", "code %s" % result.get("code"))
+        return report
+
+    def find_video_bucket(self, prefix):
+        bucket_name = get_cached_video_bucket_name(prefix)
+        if bucket_name is None:
+            bucket_name = get_latest_bucket_name(prefix=prefix)
+            with open(BUCKET_CACHE_PATH, "w") as f:
+                json.dump({"prefix": prefix, "bucket": bucket_name, "time": time.time()}, f)
+        return bucket_name
+
+
+class DropboxStore(ObjectStore):
+    """
+    A Dropbox account, with a single client. Files are listed by folder,
+    ``prefix`` being the path of the folder.
+    """
+    name = "dropbox"
+
+    def __init__(self, token):
+        self.token = token
+        self._client = None
+
+    @property
+    def client(self):
+        """
+        The client, with a pool of kept-alive connections. Retries are left
+        to :meth:`_call`.
+        """
+        if self._client is None:
+            import dropbox
+            self._client = dropbox.Dropbox(
+                self.token, session=dropbox.create_session(max_connections=REMOTE_POOL_SIZE),
+                timeout=REMOTE_TIMEOUT, max_retries_on_error=0, max_retries_on_rate_limit=0)
+        return self._client
+
+    def _call(self, method_name, *args, **kwargs):
+        """
+        Call a method of the client under :data:`dropbox_retry_policy`.
+        """
+        from dropbox.exceptions import InternalServerError, RateLimitError
+
+        def call():
+            try:
+                return getattr(self.client, method_name)(*args, **kwargs)
+            except RateLimitError as e:
+                raise TransientError("Rate limited by Dropbox", retry_after=e.backoff)
+            except InternalServerError as e:
+                raise TransientError("Dropbox server error: %s" % e)
+
+        return dropbox_retry_policy.call(call)
+
+    def hash_data(self, data):
+        return dropbox_content_hash(data)
+
+    def hash_file(self, f):
+        return dropbox_content_hash_file(f)
+
+    @staticmethod
+    def _get_file(metadata):
+        return {"key": metadata.path_lower, "hash": metadata.content_hash, "fsize": metadata.size}
+
+    def list(self, bucket_name, prefix=""):
+        from dropbox.exceptions import ApiError
+        from dropbox.files import FileMetadata
+
+        # The root folder is "" for the API.
+        folder = prefix.rstrip("/")
+        try:
+            result = self._call("files_list_folder", folder)
+        except ApiError:
+            # The folder does not exist (yet).
+            return []
+
+        items = []
+        while True:
+            for entry in result.entries:
+                if isinstance(entry, FileMetadata):
+                    items.append(self._get_file(entry))
+            if not result.has_more:
+                break
+            result = self._call("files_list_folder_continue", result.cursor)
+        return items
+
+    def stat(self, bucket_name, keys):
+        from dropbox.exceptions import ApiError
+        from dropbox.files import FileMetadata
+
+        stats = OrderedDict()
+        for key in keys:
+            try:
+                metadata = self._call("files_get_metadata", key)
+            except ApiError:
+                metadata = None
+            stats[key] = self._get_file(metadata) if isinstance(metadata, FileMetadata) else None
+        return stats
+
+    def put_file(self, bucket_name, key, file_path, progress_handler=None,
+                 upload_progress_recorder=None, buffer=None):
+        with open(file_path, "rb") as f:
+            file_hash = self.put_chunks(
+                bucket_name, key, iter(partial(f.read, BACKUP_CHUNK_SIZE), b""))
+        return {"key": key, "hash": file_hash}
+
+    def put_data(self, bucket_name, key, data):
+        from dropbox.files import WriteMode
+        return self._call("files_upload", data, key, mode=WriteMode.overwrite).content_hash
+
+    def put_many(self, bucket_name, items):
+        from dropbox.files import (
+            CommitInfo, UploadSessionCursor, UploadSessionFinishArg, WriteMode)
+
+        entries = []
+        for key, data in items:
+            session = self._call("files_upload_session_start", data, close=True)
+            entries.append(UploadSessionFinishArg(
+                cursor=UploadSessionCursor(session.session_id, offset=len(data)),
+                commit=CommitInfo(path=key, mode=WriteMode.overwrite)))
+
+        result = self._call("files_upload_session_finish_batch_v2", entries)
+
+        results = []
+        for entry in result.entries:
+            if entry.is_success():
+                results.append((entry.get_success().content_hash, None))
+            else:
+                results.append((None, str(entry.get_failure())))
+        return results
+
+    def put_chunks(self, bucket_name, key, chunks):
+        """
+        Upload the chunks in an upload session, with one request per chunk.
+        """
+        from dropbox.files import CommitInfo, UploadSessionCursor, WriteMode
+
+        session_id = None
+        offset = 0
+        for chunk in chunks:
+            if session_id is None:
+                session_id = self._call("files_upload_session_start", chunk).session_id
+            else:
+                self._call("files_upload_session_append_v2",
+                           chunk, UploadSessionCursor(session_id, offset))
+            offset += len(chunk)
+
+        if session_id is None:
+            session_id = self._call("files_upload_session_start", b"").session_id
+        return self._call(
+            "files_upload_session_finish", b"", UploadSessionCursor(session_id, offset),
+            CommitInfo(path=key, mode=WriteMode.overwrite)).content_hash
+
+    def delete(self, bucket_name, keys):
+        from dropbox.exceptions import ApiError
+
+        report = OrderedDict()
+        for key in keys:
+            try:
+                self._call("files_delete_v2", key)
+                report[key] = None
+            except ApiError as e:
+                report[key] = str(e)
+        return report
+
+
+class LocalStore(ObjectStore):
+    """
+    A stand-in for Qiniu or Dropbox, for offline runs. The files are kept in
+    a directory per bucket under ``root``, or in memory if ``root`` is None,
+    and are hashed with ``hash_data``, the hash of the store emulated.
+    Each request waits for ``latency`` seconds.
+
+    The requests and the files written are counted in the run report, as
+    "local_<name>_request" and "local_<name>_write", so that those of the
+    --jobs workers are counted too.
+    """
+    def __init__(self, name, hash_data, root=None, latency=0.):
+        self.name = name
+        self._hash_data = hash_data
+        self.root = root
+        self.latency = latency
+        # (bucket, key) -> (data, hash) in memory, path -> (size, mtime, hash)
+        # on disk.
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def hash_data(self, data):
+        return self._hash_data(data)
+
+    def _request(self):
+        instrumentation.add("local_%s_request" % self.name)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _get_path(self, bucket_name, key):
+        return os.path.join(self.root, bucket_name or "_", *key.strip("/").split("/"))
+
+    def _write(self, bucket_name, key, data):
+        file_hash = self.hash_data(data)
+        instrumentation.add("local_%s_write" % self.name, n_bytes=len(data))
+        with self._lock:
+            if self.root is None:
+                self._files[(bucket_name, key.lstrip("/"))] = (data, file_hash)
+                return file_hash
+
+        file_path = self._get_path(bucket_name, key)
+        directory, name = os.path.split(file_path)
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = os.path.join(directory, ".%d-%d-%s" % (os.getpid(), threading.get_ident(), name))
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, file_path)
+        return file_hash
+
+    def _get_file(self, bucket_name, key):
+        if self.root is None:
+            with self._lock:
+                stored = self._files.get((bucket_name, key.lstrip("/")))
+            if stored is None:
+                return None
+            data, file_hash = stored
+            return {"key": key, "hash": file_hash, "fsize": len(data)}
+
+        file_path = self._get_path(bucket_name, key)
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            return None
+
+        # Files are only hashed again when they change.
+        cached = self._files.get(file_path)
+        if cached is None or cached[:2] != (file_stat.st_size, file_stat.st_mtime_ns):
+            with open(file_path, "rb") as f:
+                file_hash = self.hash_data(f.read())
+            cached = self._files[file_path] = (file_stat.st_size, file_stat.st_mtime_ns, file_hash)
+        return {"key": key, "hash": cached[2], "fsize": cached[0]}
+
+    def _keys(self, bucket_name):
+        if self.root is None:
+            with self._lock:
+                return sorted(key for bucket, key in self._files if bucket == bucket_name)
+
+        bucket_dir = self._get_path(bucket_name, "")
+        keys = []
+        for directory, _, file_names in os.walk(bucket_dir):
+            for name in file_names:
+                if not name.startswith("."):
+                    relative_path = os.path.relpath(os.path.join(directory, name), bucket_dir)
+                    keys.append(relative_path.replace(os.sep, "/"))
+        return sorted(keys)
+
+    def list(self, bucket_name, prefix=""):
+        self._request()
+        # Keys are stored without the leading "/" of Dropbox paths.
+        leading_slash = "/" if prefix.startswith("/") else ""
+        items = []
+        for key in self._keys(bucket_name):
+            key = leading_slash + key
+            if key.startswith(prefix):
+                item = self._get_file(bucket_name, key)
+                if item is not None:
+                    items.append(item)
+        return items
+
+    def stat(self, bucket_name, keys):
+        self._request()
+        return OrderedDict((key, self._get_file(bucket_name, key)) for key in keys)
+
+    def put_file(self, bucket_name, key, file_path, progress_handler=None,
+                 upload_progress_recorder=None, buffer=None):
+        self._request()
+        if buffer is not None:
+            data = bytes(buffer)
+        else:
+            with open(file_path, "rb") as f:
+                data = f.read()
+        return {"key": key, "hash": self._write(bucket_name, key, data), "fsize": len(data)}
+
+    def put_data(self, bucket_name, key, data):
+        self._request()
+        return self._write(bucket_name, key, data)
+
+    def put_many(self, bucket_name, items):
+        # One request for the whole batch.
+        self._request()
+        return [(self._write(bucket_name, key, data), None) for key, data in items]
+
+    def put_chunks(self, bucket_name, key, chunks):
+        chunks = list(chunks)
+        for _ in chunks[1:]:
+            self._request()
+        return self.put_data(bucket_name, key, b"".join(chunks))
+
+    def delete(self, bucket_name, keys):
+        self._request()
+        report = OrderedDict()
+        for key in keys:
+            if self.root is None:
+                with self._lock:
+                    found = self._files.pop((bucket_name, key.lstrip("/")), None) is not None
+            else:
+                try:
+                    os.remove(self._get_path(bucket_name, key))
+                    found = True
+                except OSError:
+                    found = False
+            report[key] = None if found else "no such file or directory"
+        return report
+
+    def find_video_bucket(self, prefix):
+        self._request()
+        return (prefix or "videos") + "-local"
+
+
+def get_local_store(name, hash_data):
+    root = None
+    if LOCAL_STORAGE_DIR:
+        root = os.path.join(LOCAL_STORAGE_DIR, name)
+    return LocalStore(name, hash_data, root=root, latency=LOCAL_STORAGE_LATENCY)
+
+
+qiniu_store = None
+dropbox_store = None
+_store_lock = threading.Lock()
+
+
+def get_qiniu_store():
+    """
+    Return the store files linked from the pages are uploaded to.
+    """
+    global qiniu_store
+    with _store_lock:
+        if qiniu_store is None:
+            if STORAGE_BACKEND == "local":
+                qiniu_store = get_local_store(
+                    "qiniu", lambda data: qiniu_etag(data))
+            else:
+                pool_qiniu_connections()
+                qiniu_store = QiniuStore(auth, bm)
+    return qiniu_store
+
+
+def get_dropbox_store():
+    """
+    Return the store the flows are published to, None if there is none.
+    """
+    global dropbox_store
+    with _store_lock:
+        if dropbox_store is None:
+            if STORAGE_BACKEND == "local":
+                dropbox_store = get_local_store("dropbox", dropbox_content_hash)
+            else:
+                dropbox_token = os.environ.get("DROPBOX_ACCESS_TOKEN", "")
+                if dropbox_token:
+                    dropbox_store = DropboxStore(dropbox_token)
+    return dropbox_store
+
+
+class DropboxPublisher(object):
+    """
+    Publish files to a store (Dropbox). A file is skipped if the content hash
+    of the remote file at its path is the same, the others are queued and
+    uploaded together by :meth:`flush`.
+    """
+    def __init__(self, store, batch_size=DROPBOX_BATCH_SIZE):
+        self.store = store
+        self.batch_size = batch_size
+        self._remote_hashes = {}
+        self._listed_folders = set()
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self.n_uploaded = 0
+        self.n_unchanged = 0
+
+    def get_remote_hash(self, path):
+        folder = posixpath.dirname(path).lower()
+        if folder not in self._listed_folders:
+            for item in self.store.list(None, folder):
+                self._remote_hashes[item["key"].lower()] = item["hash"]
+            self._listed_folders.add(folder)
+        return self._remote_hashes.get(path.lower())
+
+    def add(self, path, f, on_published=None):
+        """
+        Queue the binary file ``f`` to be published at ``path``, unless its
+        content is already there. ``on_published`` is called once it is.
+        The file is closed by the publisher.
+        """
+        with self._lock:
+            start = time.time()
+            try:
+                content_hash = self.store.hash_file(f)
+                size = f.tell()
+                f.seek(0)
+            except BaseException:
+                f.close()
+                raise
+            instrumentation.add("dropbox_hash", time.time() - start, size)
+
+            if content_hash == self.get_remote_hash(path):
+                f.close()
+                self.n_unchanged += 1
+                if on_published is not None:
+                    on_published()
+                return
+
+            # Only the files are queued, their content is read again when the
+            # batch is uploaded. Spooled files are moved to disk, so that a
+            # batch does not hold its files in memory.
+            if hasattr(f, "rollover"):
+                f.rollover()
+            replaced = self._pending.pop(path, None)
+            if replaced is not None:
+                replaced[0].close()
+            self._pending[path] = (f, size, on_published)
+            if len(self._pending) < self.batch_size:
+                return
+        self.flush()
+
+    def upload_chunks(self, path, chunks):
+        """
+        Upload the concatenation of the byte strings ``chunks`` to ``path``.
+        """
+        return self.store.put_chunks(None, path, chunks)
+
+    def flush(self):
+        with self._lock:
+            pending = list(self._pending.items())
+            self._pending.clear()
+            if not pending:
+                return
+
+            def read_pending():
+                for path, (f, _, _) in pending:
+                    yield path, f.read()
+
+            try:
+                with instrumentation.timer(
+                        "dropbox_upload", n_bytes=sum(size for _, (_, size, _) in pending)):
+                    results = self.store.put_many(None, read_pending())
+            finally:
+                for _, (f, _, _) in pending:
+                    f.close()
+
+            failures = []
+            for (path, (_, _, on_published)), (content_hash, error) in zip(pending, results):
+                if content_hash is None:
+                    failures.append("%s: %s" % (path, error))
+                    continue
+                self._remote_hashes[path.lower()] = content_hash
+                self.n_uploaded += 1
+                if on_published is not None:
+                    on_published()
+
+        sys.stdout.write(
+            "---%d files uploaded to Dropbox, %d unchanged.---\n"
+            % (len(pending) - len(failures), self.n_unchanged))
+        if failures:
+            raise RuntimeError(
+                "Failed to upload to Dropbox:\n%s" % "\n".join(failures))
+
+
+dropbox_publisher = None
+
+
+def get_dropbox_publisher():
+    global dropbox_publisher
     if sys.platform.startswith("win"):
+        return None
+    store = get_dropbox_store()
+    if store is None:
+        return None
+
+    if dropbox_publisher is None:
+        dropbox_publisher = DropboxPublisher(store)
+    return dropbox_publisher
+
+
+def upload_to_dropbox(file_name, f, on_published=None):
+    """
+    Publish the binary file ``f``, which is closed, at ``file_name``.
+    """
+    publisher = get_dropbox_publisher()
+    if publisher is None:
+        f.close()
+        if on_published is not None:
+            on_published()
         return
-    dropbox_token = os.environ.get("DROPBOX_ACCESS_TOKEN", "")
-    if not dropbox_token:
+    publisher.add(file_name, f, on_published)
+
+
+def flush_dropbox():
+    publisher = get_dropbox_publisher()
+    if publisher is not None:
+        publisher.flush()
+
+
+def publish_file(dropbox_path, output, local_path, on_published=None):
+    """
+    Publish the rendered file ``output`` (a binary file, which is closed) at
+    ``dropbox_path``, to the bundle of its course too if there are bundles.
+    On Windows, it is written to ``local_path`` instead of Dropbox.
+    """
+    try:
+        if sys.platform.startswith("win"):
+            with open(local_path, "w", encoding="utf-8") as f:
+                shutil.copyfileobj(codecs.getreader("utf-8")(output), f)
+            output.seek(0)
+
+        if BUNDLE_DIR:
+            write_bundle_file(dropbox_path, output)
+            output.seek(0)
+    except BaseException:
+        output.close()
+        raise
+
+    # The file is queued as it is, rather than its content.
+    upload_to_dropbox(dropbox_path, output, on_published=on_published)
+
+
+# Where each course is also written as a single bundle of its flows and
+# course chunk files, replaced at once when the course is done: a directory
+# <course_slug> ("dir") or a file <course_slug>.tar ("tar"). No bundles if
+# empty.
+BUNDLE_DIR = os.environ.get("BUNDLE_DIR", "")
+BUNDLE_FORMAT = os.environ.get("BUNDLE_FORMAT", "dir")
+
+
+def get_bundle_staging_dir(course_slug):
+    return os.path.join(BUNDLE_DIR, ".%s.staging" % course_slug)
+
+
+def get_bundle_file_path(dropbox_path):
+    """
+    Return where the file published at ``dropbox_path`` is staged.
+    """
+    course_slug, relative_path = dropbox_path.lstrip("/").split("/", 1)
+    return os.path.join(get_bundle_staging_dir(course_slug), relative_path)
+
+
+def get_bundle_rebuild_reason(dropbox_path):
+    """
+    Return why a file which is up to date has to be generated anyway: it is
+    missing from the bundle. None if it is not.
+    """
+    if BUNDLE_DIR and not os.path.exists(get_bundle_file_path(dropbox_path)):
+        return "not in bundle"
+    return None
+
+
+def write_bundle_file(dropbox_path, output):
+    path = get_bundle_file_path(dropbox_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # The staged file may be a link to the file of the current bundle,
+    # replace it rather than write into it.
+    with open(path + ".tmp", "wb") as f:
+        shutil.copyfileobj(output, f)
+    os.replace(path + ".tmp", path)
+
+
+def open_bundle(course_slug):
+    """
+    Start the staging directory of the bundle of a course, with the files of
+    its current bundle, which are kept unless they are generated again.
+    """
+    staging_dir = get_bundle_staging_dir(course_slug)
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir)
+
+    if BUNDLE_FORMAT == "tar":
+        tar_path = os.path.join(BUNDLE_DIR, "%s.tar" % course_slug)
+        os.makedirs(staging_dir)
+        if os.path.exists(tar_path):
+            with tarfile.open(tar_path) as tar:
+                prefix = course_slug + "/"
+                members = [member for member in tar.getmembers()
+                           if member.isfile() and member.name.startswith(prefix)
+                           and ".." not in member.name.split("/")]
+                for member in members:
+                    member.name = member.name[len(prefix):]
+                tar.extractall(staging_dir, members=members)
+    else:
+        current_dir = os.path.join(BUNDLE_DIR, course_slug)
+        if os.path.isdir(current_dir):
+            shutil.copytree(os.path.realpath(current_dir), staging_dir, copy_function=os.link)
+        else:
+            os.makedirs(staging_dir)
+
+
+def commit_bundle(course_slug):
+    """
+    Replace the bundle of a course with its staging directory, in a single
+    rename: of the tar file, or of the symlink to the directory.
+    """
+    staging_dir = get_bundle_staging_dir(course_slug)
+    if BUNDLE_FORMAT == "tar":
+        tar_path = os.path.join(BUNDLE_DIR, "%s.tar" % course_slug)
+        with tarfile.open(tar_path + ".tmp", "w") as tar:
+            tar.add(staging_dir, arcname=course_slug)
+        os.replace(tar_path + ".tmp", tar_path)
+        shutil.rmtree(staging_dir)
+    else:
+        bundle_path = os.path.join(BUNDLE_DIR, course_slug)
+        version_dir = ".%s.%s" % (course_slug, datetime.now().strftime("%Y%m%d%H%M%S%f"))
+        os.rename(staging_dir, os.path.join(BUNDLE_DIR, version_dir))
+
+        previous_dir = None
+        if os.path.islink(bundle_path):
+            previous_dir = os.path.realpath(bundle_path)
+        elif os.path.isdir(bundle_path):
+            shutil.rmtree(bundle_path)
+
+        link_path = os.path.join(BUNDLE_DIR, ".%s.link" % course_slug)
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        os.symlink(version_dir, link_path)
+        os.replace(link_path, bundle_path)
+
+        if previous_dir is not None and os.path.isdir(previous_dir):
+            shutil.rmtree(previous_dir)
+    sys.stdout.write("Bundle of %s written to %s.\n" % (course_slug, BUNDLE_DIR))
+
+
+# Size of the chunks the database is read, compressed and uploaded in.
+BACKUP_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def snapshot_database(snapshot_path):
+    """
+    Copy a consistent snapshot of the database to ``snapshot_path``, even if
+    coursera-dl is writing to it.
+    """
+    source = sqlite3.connect(DB_PATH)
+    try:
+        dest = sqlite3.connect(snapshot_path)
+        try:
+            if hasattr(source, "backup"):
+                source.backup(dest)
+                return
+        finally:
+            dest.close()
+
+        # No online backup API before Python 3.7, copy the file while a read
+        # transaction keeps writers from committing.
+        source.execute("BEGIN")
+        source.execute("SELECT count(*) FROM sqlite_master").fetchall()
+        with open(DB_PATH, "rb") as src, open(snapshot_path, "wb") as dst:
+            for chunk in iter(partial(src.read, BACKUP_CHUNK_SIZE), b""):
+                dst.write(chunk)
+        source.rollback()
+    finally:
+        source.close()
+
+
+def iter_gzip_chunks(file_path, chunk_size=BACKUP_CHUNK_SIZE):
+    """
+    Compress the file with gzip as it is read, yielding chunks of about
+    ``chunk_size`` bytes.
+    """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    pending = b""
+    with open(file_path, "rb") as f:
+        for block in iter(partial(f.read, chunk_size), b""):
+            pending += compressor.compress(block)
+            if len(pending) >= chunk_size:
+                yield pending
+                pending = b""
+    yield pending + compressor.flush()
+
+
+def backup_database():
+    """
+    Upload a compressed snapshot of the database to Dropbox, unless it is
+    the same as the one uploaded last.
+    """
+    publisher = get_dropbox_publisher()
+    if publisher is None or not os.path.isfile(DB_PATH):
         return
 
-    import dropbox
-    from dropbox.files import WriteMode
-    dbx = dropbox.Dropbox(dropbox_token)
-    return dbx.files_upload(file_content, file_name, mode=WriteMode.overwrite)
+    snapshot_dir = tempfile.mkdtemp(dir=LOCAL_PATH_PREFIX)
+    try:
+        snapshot_path = os.path.join(snapshot_dir, "coursera-dl.db")
+        snapshot_database(snapshot_path)
+
+        snapshot_hash = hashlib.sha1()
+        with open(snapshot_path, "rb") as f:
+            for chunk in iter(partial(f.read, BACKUP_CHUNK_SIZE), b""):
+                snapshot_hash.update(chunk)
+        snapshot_hash = snapshot_hash.hexdigest()
+
+        if get_rebuild_reason(DB_PATH, snapshot_hash, incremental=True) is None:
+            sys.stdout.write("---Database unchanged since the last backup.---\n")
+            return
+
+        backup_path = "/course_%s.db.gz" % datetime.now().strftime("%Y-%m-%d-%H-%M")
+        publisher.upload_chunks(backup_path, iter_gzip_chunks(snapshot_path))
+        store_fingerprint(DB_PATH, snapshot_hash)
+        sys.stdout.write("---Database backed up to %s.---\n" % backup_path)
+    finally:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
 
 
 def tqdmWrapViewBar(*args, **kwargs):
@@ -539,15 +2895,168 @@ def tqdmWrapViewBar(*args, **kwargs):
 
 def get_bucket_course_files(course_slug, bucket_name):
     course_prefix = "%s/%s" % (IN_BUCKET_PREFIX, course_slug)
-    ret, _, _ = bm.list(bucket=bucket_name, prefix=course_prefix)
-    return ret['items']
-
-
-def _upload(course_slug, bucket_name, file_path):
+    return get_qiniu_store().list(bucket_name, course_prefix)
+
+
+class BucketIndex(object):
+    """
+    Index of hash -> key of the files of a course in a bucket, as they were
+    before the uploads of the run. The bucket is listed once per (bucket,
+    course), before any file of the course is uploaded.
+
+    Files uploaded in the run are not indexed: a file is only deduplicated
+    against the files which were already there, so that which key it gets
+    does not depend on the order in which the uploads (threads or --jobs
+    workers) complete.
+    """
+    def __init__(self):
+        self._hash_to_key = {}
+        self._key_to_hash = {}
+        self._lock = threading.Lock()
+
+    def _get(self, bucket_name, course_slug):
+        index_key = (bucket_name, course_slug)
+        if index_key not in self._hash_to_key:
+            hash_to_key = {}
+            key_to_hash = {}
+            for item in get_bucket_course_files(course_slug, bucket_name):
+                hash_to_key.setdefault(item["hash"], item["key"])
+                key_to_hash[item["key"]] = item["hash"]
+            self._hash_to_key[index_key] = hash_to_key
+            self._key_to_hash[index_key] = key_to_hash
+        return self._hash_to_key[index_key], self._key_to_hash[index_key]
+
+    def find(self, bucket_name, course_slug, file_etag):
+        with self._lock:
+            hash_to_key, _ = self._get(bucket_name, course_slug)
+            return hash_to_key.get(file_etag)
+
+    def load(self, bucket_name, course_slug):
+        """
+        List the files of the course in the bucket, if not done yet.
+        """
+        with self._lock:
+            self._get(bucket_name, course_slug)
+
+    def get_state(self):
+        with self._lock:
+            return self._hash_to_key, self._key_to_hash
+
+    def set_state(self, state):
+        """
+        Use the listings of another index (of the parent of a --jobs worker).
+        """
+        with self._lock:
+            self._hash_to_key, self._key_to_hash = state
+
+    def forget(self):
+        """
+        Drop the listings, the buckets are listed again when next needed.
+        """
+        with self._lock:
+            self._hash_to_key = {}
+            self._key_to_hash = {}
+
+    def remove(self, bucket_name, course_slug, keys):
+        """
+        Forget the files at ``keys``, which were deleted from the bucket or
+        overwritten with new content.
+        """
+        with self._lock:
+            index_key = (bucket_name, course_slug)
+            if index_key not in self._hash_to_key:
+                return
+            hash_to_key = self._hash_to_key[index_key]
+            key_to_hash = self._key_to_hash[index_key]
+            for key in keys:
+                file_hash = key_to_hash.pop(key, None)
+                if file_hash is not None and hash_to_key.get(file_hash) == key:
+                    del hash_to_key[file_hash]
+
+
+bucket_index = BucketIndex()
+
+
+class BatchBucketManager(object):
+    """
+    Stat and delete files of a store in batches (of requests to Qiniu).
+
+    Stats can be prefetched for many keys at once, :meth:`stat_one` then
+    answers from the prefetched results before asking the store.
+    """
+    def __init__(self, store=None):
+        self._store = store
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @property
+    def store(self):
+        return self._store or get_qiniu_store()
+
+    def stat(self, bucket_name, keys):
+        """
+        Return an ordered dict of key -> stat result of the file, None if the
+        file does not exist or its stat failed.
+        """
+        with instrumentation.timer("stat"):
+            return self.store.stat(bucket_name, keys)
+
+    def prefetch_stat(self, bucket_name, keys):
+        with self._lock:
+            keys = [key for key in keys if (bucket_name, key) not in self._stats]
+        if not keys:
+            return
+        stats = self.stat(bucket_name, keys)
+        with self._lock:
+            for key, ret in stats.items():
+                self._stats[(bucket_name, key)] = ret
+
+    def stat_one(self, bucket_name, key):
+        with self._lock:
+            if (bucket_name, key) in self._stats:
+                return self._stats.pop((bucket_name, key))
+        return self.stat(bucket_name, [key])[key]
+
+    def forget(self):
+        """
+        Drop the prefetched stats which were not used.
+        """
+        with self._lock:
+            self._stats.clear()
+
+    def delete(self, bucket_name, keys):
+        """
+        Delete the files, and return an ordered dict of key -> error message,
+        None if the file was deleted.
+        """
+        with self._lock:
+            for key in keys:
+                self._stats.pop((bucket_name, key), None)
+        return self.store.delete(bucket_name, keys)
+
+
+batch_bucket_manager = BatchBucketManager()
+
+
+def _upload(course_slug, bucket_name, file_path, file_etag=None, upload_path=None,
+            buffer=None):
+    """
+    Upload ``file_path``, or the content of ``upload_path`` in its place,
+    unless the bucket already has it. Return the key of the file.
+
+    ``buffer`` is the content of ``upload_path`` mapped in memory, which is
+    then hashed and uploaded from without reading the file again.
+    """
     qiniu_file_path = join(IN_BUCKET_PREFIX, file_path, )
+    if upload_path is None:
+        upload_path = file_path
 
-    file_etag = etag(file_path)
-    ret, _ = bm.stat(bucket_name, qiniu_file_path)
+    if file_etag is None:
+        if buffer is None:
+            file_etag = hash_file(upload_path, course_slug)
+        else:
+            file_etag = hash_buffer(buffer, course_slug)
+    ret = batch_bucket_manager.stat_one(bucket_name, qiniu_file_path)
 
     # Check if the file exists / changed, if not, upload or update.
     if ret and "hash" in ret:
@@ -556,70 +3065,387 @@ def _upload(course_slug, bucket_name, file_path):
             return qiniu_file_path
 
     # The file already exist, but it has another name, the we return the name.
-    bucket_course_files = get_bucket_course_files(course_slug, bucket_name)
-    for item in bucket_course_files:
-        if item['hash'] == file_etag:
-            sys.stdout.write(
-                "File with hash '%s' already exist (with another name).\n"
-                % (file_etag[:10] + "...",))
-            return item['key']
+    existing_key = bucket_index.find(bucket_name, course_slug, file_etag)
+    if existing_key is not None:
+        sys.stdout.write(
+            "File with hash '%s' already exist (with another name).\n"
+            % (file_etag[:10] + "...",))
+        return existing_key
 
     sys.stdout.write(
         "File with hash '%s' changed, will be overwritten.\n" % (file_etag[:10] + "...",))
 
-    size = os.stat(file_path).st_size / 1024 / 1024
+    file_size = os.stat(upload_path).st_size
     sys.stdout.write(
-        "Uploading file with hash %s (size: %.1fM)\n" % ((file_etag[:10] + "...",), size))
-    token = auth.upload_token(bucket_name, qiniu_file_path, 3600)
+        "Uploading file with hash %s (size: %.1fM)\n"
+        % ((file_etag[:10] + "...",), file_size / 1024 / 1024))
 
-    cbk, pbar = tqdmWrapViewBar(ascii=True, unit='b', unit_scale=True)
-    ret, _ = put_file(token, qiniu_file_path, file_path, progress_handler=cbk)
+    upload_progress_recorder = None
+    if file_size > RESUMABLE_UPLOAD_THRESHOLD:
+        if not os.path.isdir(UPLOAD_RECORD_DIR):
+            os.makedirs(UPLOAD_RECORD_DIR, exist_ok=True)
+        upload_progress_recorder = UploadProgressRecorder(UPLOAD_RECORD_DIR)
 
-    pbar.close()
-    try:
-        return ret['key']
-    except (TypeError, KeyError):
-        # Retry upload
-        return _upload(course_slug, bucket_name, file_path)
+    def upload():
+        cbk, pbar = tqdmWrapViewBar(ascii=True, unit='b', unit_scale=True)
+        try:
+            with instrumentation.timer("upload", n_bytes=file_size, course=course_slug):
+                return get_qiniu_store().put_file(
+                    bucket_name, qiniu_file_path, upload_path, progress_handler=cbk,
+                    upload_progress_recorder=upload_progress_recorder, buffer=buffer)
+        finally:
+            pbar.close()
+
+    key = qiniu_retry_policy.call(upload)["key"]
+
+    # The key does not hold the content it was listed with anymore.
+    bucket_index.remove(bucket_name, course_slug, [key])
+    return key
+
+
+def is_image(file_path):
+    return os.path.splitext(file_path)[1].lower() in IMAGE_EXTENSIONS
+
+
+def get_upload_width(file_path):
+    """
+    Return the width an image is resized to before it is uploaded, None if
+    the file is not an image.
+    """
+    if is_image(file_path):
+        return IMAGE_WIDTHS[0]
+    return None
+
+
+# normpath -> (size, mtime_ns, etag) of the source images hashed in this
+# process, so that an image is hashed once for its derivatives.
+_image_etags = {}
+_image_etags_lock = threading.Lock()
+
+
+def get_image_etag(file_path):
+    """
+    Return the qiniu etag of the image ``file_path``, hashing it only if it
+    changed since it was last hashed.
+    """
+    file_path = os.path.normpath(file_path)
+    file_stat = os.stat(file_path)
+    with _image_etags_lock:
+        cached = _image_etags.get(file_path)
+    if cached is not None and cached[:2] == (file_stat.st_size, file_stat.st_mtime_ns):
+        return cached[2]
+
+    file_etag = hash_file(file_path)
+    with _image_etags_lock:
+        _image_etags[file_path] = (file_stat.st_size, file_stat.st_mtime_ns, file_etag)
+    return file_etag
+
+
+def get_image_derivative_paths(file_path, source_etag):
+    """
+    Return an ordered dict of width -> path of the cached derivatives of an
+    image.
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    return OrderedDict(
+        (width, os.path.join(IMAGE_CACHE_DIR, "%s_%d%s" % (source_etag, width, ext)))
+        for width in IMAGE_WIDTHS)
+
+
+def resize_image(source_path, derivative_paths):
+    """
+    Write the derivatives of an image which are missing. An image which is
+    not wider than a derivative gets an empty ".orig" marker in its place,
+    so that it is not opened again.
+    """
+    from PIL import Image
+    img = Image.open(source_path)
+    img_width, img_height = img.size
+
+    for width, derivative_path in derivative_paths.items():
+        if os.path.exists(derivative_path) or os.path.exists(derivative_path + ".orig"):
+            continue
 
+        directory, name = os.path.split(derivative_path)
+        tmp_path = os.path.join(directory, ".%d-%s" % (os.getpid(), name))
+        if img_width > width:
+            wpercent = (width / float(img_width))
+            hsize = int((float(img_height) * float(wpercent)))
+            img.resize((width, hsize), Image.LANCZOS).save(tmp_path, format=img.format)
+        else:
+            derivative_path += ".orig"
+            open(tmp_path, "w").close()
+        os.replace(tmp_path, derivative_path)
+
+
+def get_resized_image(file_path, source_etag=None):
+    """
+    Return the path of the image to upload in place of ``file_path``: its
+    derivative for the first of IMAGE_WIDTHS, or ``file_path`` itself if it
+    is not wider than that. The derivatives are generated if needed.
+    """
+    if source_etag is None:
+        source_etag = get_image_etag(file_path)
+    derivative_paths = get_image_derivative_paths(file_path, source_etag)
+    if not all(os.path.exists(path) or os.path.exists(path + ".orig")
+               for path in derivative_paths.values()):
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        with instrumentation.timer("resize"):
+            resize_image(file_path, derivative_paths)
+
+    path = derivative_paths[IMAGE_WIDTHS[0]]
+    if os.path.exists(path):
+        return path
+    return file_path
+
+
+_image_pool = None
+_image_pool_lock = threading.Lock()
+
+
+def prepare_image_derivatives(file_paths):
+    """
+    Generate the missing derivatives of the images in ``file_paths`` across
+    a pool of IMAGE_WORKERS processes.
+    """
+    global _image_pool
+
+    jobs = []
+    for file_path in file_paths:
+        derivative_paths = get_image_derivative_paths(file_path, get_image_etag(file_path))
+        if not all(os.path.exists(path) or os.path.exists(path + ".orig")
+                   for path in derivative_paths.values()):
+            jobs.append((file_path, derivative_paths))
+    if not jobs:
+        return
 
-def upload_resource_to_qiniu(course_slug, file_path):
-    if not auth or not upload_to_qiniu:
+    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+
+    # Workers of --jobs are daemonic and can't start processes of their own,
+    # they resize their images themselves.
+    if len(jobs) == 1 or IMAGE_WORKERS < 2 or multiprocessing.current_process().daemon:
+        for file_path, derivative_paths in jobs:
+            with instrumentation.timer("resize"):
+                resize_image(file_path, derivative_paths)
         return
 
-    _, ext = os.path.splitext(file_path)
-    if ext.lower() in [".jpg", ".png", ".gif"]:
-        basewidth = 1024
+    with _image_pool_lock:
+        if _image_pool is None:
+            # Spawned, as forking would copy the threads and connections of
+            # this process while the uploads are running.
+            _image_pool = multiprocessing.get_context("spawn").Pool(IMAGE_WORKERS)
+    with instrumentation.timer("resize_batch"):
+        results = [_image_pool.apply_async(resize_image, (file_path, derivative_paths))
+                   for file_path, derivative_paths in jobs]
+        for result in results:
+            result.get()
 
-        from PIL import Image
-        img = Image.open(file_path)
-        img_width, img_height = img.size
 
-        if img_width > basewidth:
-            wpercent = (basewidth / float(img_width))
-            hsize = int((float(img_height) * float(wpercent)))
-            img = img.resize((basewidth, hsize), Image.ANTIALIAS)
-            img.save(file_path)
+def shutdown_image_pool():
+    global _image_pool
+    with _image_pool_lock:
+        if _image_pool is not None:
+            _image_pool.close()
+            _image_pool.join()
+            _image_pool = None
 
+
+def get_upload_bucket_name(file_path):
     if file_path.lower().endswith("mp4"):
-        return _upload(course_slug, qiniu_video_bucket_name, file_path)
-    else:
-        return _upload(course_slug, QINIU_BUCKET_NAME, file_path)
+        return get_video_bucket_name()
+    return QINIU_BUCKET_NAME
+
+
+@contextmanager
+def upload_lock(file_path):
+    """
+    Hold an exclusive lock on ``file_path`` across processes, so that a file
+    referenced from flows converted by different workers is uploaded once.
+    """
+    if fcntl is None:
+        yield
+        return
+
+    os.makedirs(UPLOAD_LOCK_DIR, exist_ok=True)
+    lock_name = hashlib.sha1(os.path.normpath(file_path).encode("utf-8")).hexdigest()
+    with open(os.path.join(UPLOAD_LOCK_DIR, lock_name), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def upload_resource_to_qiniu(course_slug, file_path):
+    if not upload_to_qiniu:
+        return
+
+    # Another process might have uploaded the file while we waited, in which
+    # case the manifest tells so.
+    with upload_lock(file_path):
+        return _upload_resource_to_qiniu(course_slug, file_path)
+
+
+def _upload_resource_to_qiniu(course_slug, file_path):
+    bucket_name = get_upload_bucket_name(file_path)
+
+    entry = None
+    if not FORCE_VERIFY:
+        entry = get_manifest_entry(file_path)
+
+    if entry is not None and entry.bucket == bucket_name and entry.key:
+        return entry.key
+
+    upload_path = file_path
+    if is_image(file_path):
+        upload_path = get_resized_image(file_path)
+
+    # The file is read once, hashed and uploaded from the same mapping.
+    with map_file(upload_path) as buffer:
+        if entry is None:
+            file_etag = hash_buffer(buffer, course_slug)
+        else:
+            # Unchanged file, but not uploaded to this bucket yet.
+            file_etag = entry.etag
+
+        key = _upload(course_slug, bucket_name, file_path, file_etag, upload_path, buffer)
+    update_manifest(file_path, file_etag, bucket_name, key)
+    return key
+
+
+class UploadScheduler(object):
+    """
+    Run uploads to Qiniu in a pool of threads. Each path is only uploaded
+    once, all the jobs for the same path share a future which resolves to
+    the key of the file in the bucket. That key does not depend on the
+    order in which the uploads complete, see :class:`BucketIndex`.
+    """
+    def __init__(self, max_workers=UPLOAD_WORKERS):
+        self.max_workers = max_workers
+        self._executor = None
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, course_slug, file_path):
+        path_key = os.path.normpath(file_path)
+        with self._lock:
+            future = self._futures.get(path_key)
+            if future is None:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+                future = self._executor.submit(upload_resource_to_qiniu, course_slug, file_path)
+                self._futures[path_key] = future
+        return future
+
+    def submit_many(self, course_slug, file_paths):
+        """
+        Submit the uploads of ``file_paths``. The remote stats of the files
+        which are new to this run and not in the manifest are fetched in
+        batches first, instead of one request per file.
+        """
+        with self._lock:
+            new_paths = [path for path in file_paths
+                         if os.path.normpath(path) not in self._futures]
+
+        keys_by_bucket = OrderedDict()
+        images = []
+        for path in new_paths:
+            bucket_name = get_upload_bucket_name(path)
+            entry = None if FORCE_VERIFY else get_manifest_entry(path)
+            if entry is not None and entry.bucket == bucket_name and entry.key:
+                continue
+            keys_by_bucket.setdefault(bucket_name, []).append(join(IN_BUCKET_PREFIX, path))
+            if is_image(path):
+                images.append(path)
+
+        for bucket_name, keys in keys_by_bucket.items():
+            batch_bucket_manager.prefetch_stat(bucket_name, keys)
+
+        prepare_image_derivatives(images)
+
+        return [self.submit(course_slug, path) for path in file_paths]
+
+    def wait(self, file_paths):
+        """
+        Wait for the uploads of those of ``file_paths`` which were submitted,
+        raising the error of a failed one.
+        """
+        with self._lock:
+            futures = [self._futures.get(os.path.normpath(path)) for path in file_paths]
+        for future in futures:
+            if future is not None:
+                future.result()
+
+    def forget(self):
+        """
+        Forget the uploads which are done, so that their files are checked
+        again when they are next submitted.
+        """
+        with self._lock:
+            for path_key, future in list(self._futures.items()):
+                if future.done():
+                    del self._futures[path_key]
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+upload_scheduler = UploadScheduler()
+
+
+def report_deleted_files(report):
+    n_deleted_file = 0
+    for key, error in report.items():
+        if error is None:
+            n_deleted_file += 1
+        else:
+            sys.stdout.write("Failed to delete '%s': %s\n" % (key, error))
+    sys.stdout.write(
+        "---%d duplicated files where deleted.---\n" % n_deleted_file)
+
+
+def forget_deleted_files(course_slug, bucket_name, report):
+    """
+    Forget the files of the course deleted from the bucket, as reported by
+    :meth:`BatchBucketManager.delete`: their manifest entries, so that they
+    are uploaded again, their entries in the bucket index, and the
+    fingerprints of the files published for the course, which may link to
+    them.
+    """
+    deleted_keys = [key for key, error in report.items() if error is None]
+    if not deleted_keys:
+        return
+
+    bucket_index.remove(bucket_name, course_slug, deleted_keys)
+    with cache_database.atomic():
+        # SQLite limits the number of parameters of a query.
+        for start in range(0, len(deleted_keys), 500):
+            (UploadManifest.delete()
+             .where((UploadManifest.bucket == bucket_name)
+                    & UploadManifest.key.in_(deleted_keys[start:start + 500]))
+             .execute())
+        (BuildFingerprint.delete()
+         .where(BuildFingerprint.path.startswith("/%s/" % course_slug))
+         .execute())
 
 
 def remove_duplicate_files(course_slug, bucket_name):
     course_files = get_bucket_course_files(course_slug, bucket_name)
-    exist_hashes = []
-    n_deleted_file = 0
+    exist_hashes = set()
+    duplicated_keys = []
     for course_file in course_files:
         if course_file["hash"] in exist_hashes:
-            bm.delete(bucket_name, course_file["key"])
-            n_deleted_file += 1
+            duplicated_keys.append(course_file["key"])
         else:
-            exist_hashes.append(course_file["hash"])
+            exist_hashes.add(course_file["hash"])
 
-    sys.stdout.write(
-        "---%d duplicated files where deleted.---\n" % n_deleted_file)
+    report = batch_bucket_manager.delete(bucket_name, duplicated_keys)
+    forget_deleted_files(course_slug, bucket_name, report)
+    report_deleted_files(report)
+    return report
 
 
 def remove_specific_files(course_slug, extension=".pdf", bucket_name=QINIU_BUCKET_NAME):
@@ -627,33 +3453,452 @@ def remove_specific_files(course_slug, extension=".pdf", bucket_name=QINIU_BUCKE
     if not course_files:
         return
 
-    n_deleted_file = 0
-    for course_file in course_files:
-        if course_file["key"].lower().endswith(extension.lower()):
-            bm.delete(bucket_name, course_file["key"])
-            n_deleted_file += 1
+    keys = [course_file["key"] for course_file in course_files
+            if course_file["key"].lower().endswith(extension.lower())]
 
-    sys.stdout.write(
-        "---%d duplicated files where deleted.---\n" % n_deleted_file)
+    report = batch_bucket_manager.delete(bucket_name, keys)
+    forget_deleted_files(course_slug, bucket_name, report)
+    report_deleted_files(report)
+    return report
 
 
-def main():
-    if os.path.isfile(DB_PATH):
-        with open(DB_PATH, 'rb') as f:
-            data = f.read()
-            upload_to_dropbox("/course_%s.db" % datetime.now().strftime("%Y-%m-%d-%H-%M"), data)
+# How often the database is checked for changes in --watch mode, and for how
+# long it must not have changed before the flows are generated again.
+WATCH_INTERVAL = float(os.environ.get("WATCH_INTERVAL", "5"))
+WATCH_DEBOUNCE = float(os.environ.get("WATCH_DEBOUNCE", "30"))
+
 
+# The throughput measured by the last runs, from which --plan estimates how
+# long a run would take.
+THROUGHPUT_PATH = os.path.join(LOCAL_PATH_PREFIX, ".throughput.json")
+
+
+def load_throughput():
     try:
-        with database:
-            courses = Course.select()
+        with open(THROUGHPUT_PATH, "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_throughput():
+    """
+    Record the throughput of this run: bytes per second of the hashes, of an
+    upload thread and of the Dropbox uploads, seconds per resized image and
+    per page. The rates which this run did not measure are kept.
+    """
+    operations = instrumentation.get_report()["operations"]
+    throughput = load_throughput()
+
+    for operation in ["hash", "upload", "dropbox_upload"]:
+        entry = operations.get(operation)
+        if entry and entry["bytes"] and entry["time"] > 0:
+            throughput[operation] = entry["bytes"] / entry["time"]
+
+    entry = operations.get("resize")
+    if entry and entry["count"]:
+        throughput["resize"] = entry["time"] / entry["count"]
+
+    # Rendering includes finishing the pages.
+    entry = operations.get("prepare_page")
+    if entry and entry["count"]:
+        render_time = operations.get("render", {}).get("time", 0.)
+        throughput["page"] = (entry["time"] + render_time) / entry["count"]
+
+    with open(THROUGHPUT_PATH, "w") as f:
+        json.dump(throughput, f, indent=2)
+
+
+def format_size(n_bytes):
+    if n_bytes < 1024 * 1024:
+        return "%.1fK" % (n_bytes / 1024)
+    return "%.1fM" % (n_bytes / 1024 / 1024)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%dh%02dm" % (hours, minutes)
+    if minutes:
+        return "%dm%02ds" % (minutes, seconds)
+    return "%ds" % seconds
+
+
+class Plan(object):
+    """
+    What a run would do, worked out along the paths of :func:`generate_yamls`
+    and :func:`_upload_resource_to_qiniu` without uploading or publishing
+    anything. Files are known to be uploaded from the manifest only: a file
+    which is not in it is counted as an upload, which the run might find it
+    does not need.
+    """
+    def __init__(self):
+        self.n_courses = 0
+        self.n_flows = 0
+        self.n_pages = 0
+        self.publish_bytes = 0
+        self.changed_files = []
+        self.n_files = 0
+        self.n_missing_files = 0
+        self.n_up_to_date_files = 0
+        self.n_hashes = 0
+        self.hash_bytes = 0
+        # bucket -> [number of files, bytes]
+        self.uploads = OrderedDict()
+        self.images_to_resize = []
+        self._seen_paths = set()
+
+    def add_course(self, course_slug):
+        course_data = CourseData(course_slug)
+        self.n_courses += 1
+
+        jobs = get_course_flow_jobs(course_data)
+        for job in jobs:
+            self.n_flows += 1
+            reason = get_rebuild_reason(
+                job.dropbox_path,
+                get_pages_fingerprint(course_data, job.items, *job.flow_attrs))
+            if reason is None:
+                continue
 
-        course_slug_list = [c.course_slug for c in courses]
-        for course_slug in course_slug_list:
-            # remove_duplicate_files(course_slug, QINIU_BUCKET_NAME)
-            # remove_specific_files(course_slug)
-            # remove_specific_files(course_slug, extension=".jpg")
-            # remove_specific_files(course_slug, extension=".png")
-            generate_yamls(course_slug)
+            self.changed_files.append((job.dropbox_path, reason))
+            self.publish_bytes += job.weight
+            for item in job.items:
+                if getattr(item, "type_name", None) == "lecture" or item.content:
+                    self.n_pages += 1
+                if upload_to_qiniu and not sys.platform.startswith("win"):
+                    for path in get_item_asset_paths(item, course_data):
+                        self.add_file(course_slug, path)
+
+        flows = [job.flow for job in jobs]
+        for template_name, yaml_path in get_course_yml_paths(course_slug):
+            dropbox_path = "/" + os.path.join(course_slug, yaml_path)
+            reason = get_rebuild_reason(
+                dropbox_path, get_course_yml_fingerprint(course_data.course, flows, template_name))
+            if reason is not None:
+                self.changed_files.append((dropbox_path, reason))
+
+    def add_file(self, course_slug, file_path):
+        path_key = os.path.normpath(file_path)
+        if path_key in self._seen_paths:
+            return
+        self._seen_paths.add(path_key)
+
+        if not os.path.isfile(file_path):
+            self.n_missing_files += 1
+            return
+        self.n_files += 1
+
+        bucket_name = get_upload_bucket_name(file_path)
+        entry = None if FORCE_VERIFY else get_manifest_entry(file_path)
+        if entry is not None and entry.bucket == bucket_name and entry.key:
+            self.n_up_to_date_files += 1
+            return
+
+        upload_path = file_path
+        if is_image(file_path):
+            # As get_resized_image(), without resizing.
+            derivative_paths = get_image_derivative_paths(file_path, get_image_etag(file_path))
+            if all(os.path.exists(path) or os.path.exists(path + ".orig")
+                   for path in derivative_paths.values()):
+                if os.path.exists(derivative_paths[IMAGE_WIDTHS[0]]):
+                    upload_path = derivative_paths[IMAGE_WIDTHS[0]]
+            else:
+                self.images_to_resize.append(file_path)
+
+        file_size = os.stat(upload_path).st_size
+        if entry is None:
+            self.n_hashes += 1
+            self.hash_bytes += file_size
+        uploads = self.uploads.setdefault(bucket_name, [0, 0])
+        uploads[0] += 1
+        uploads[1] += file_size
+
+    def get_estimate(self, throughput):
+        """
+        Return an ordered dict of step -> estimated seconds, None for the
+        steps which were never measured, as if the steps did not overlap.
+        """
+        upload_bytes = sum(n_bytes for _, n_bytes in self.uploads.values())
+        work = [
+            ("hash", self.hash_bytes, throughput.get("hash"), True),
+            ("upload", upload_bytes, throughput.get("upload"), True),
+            ("resize", len(self.images_to_resize), throughput.get("resize"), False),
+            ("pages", self.n_pages, throughput.get("page"), False),
+            ("publish", self.publish_bytes, throughput.get("dropbox_upload"), True),
+        ]
+        estimate = OrderedDict()
+        for step, amount, rate, is_rate in work:
+            if not amount:
+                estimate[step] = 0.
+            elif not rate:
+                estimate[step] = None
+            else:
+                estimate[step] = amount / rate if is_rate else amount * rate
+        if estimate["upload"]:
+            estimate["upload"] /= upload_scheduler.max_workers
+        if estimate["resize"]:
+            estimate["resize"] /= max(1, IMAGE_WORKERS)
+        return estimate
+
+    def write(self, throughput):
+        n_changed_flows = len([path for path, _ in self.changed_files if "/flows/" in path])
+        sys.stdout.write("---Plan (nothing is uploaded or published).---\n")
+        sys.stdout.write(
+            "%d courses, %d flows: %d to generate, with %d pages.\n"
+            % (self.n_courses, self.n_flows, n_changed_flows, self.n_pages))
+        sys.stdout.write(
+            "%d files linked from them: %d up to date, %d missing.\n"
+            % (self.n_files + self.n_missing_files, self.n_up_to_date_files,
+               self.n_missing_files))
+        sys.stdout.write(
+            "To hash: %d files, %s.\n" % (self.n_hashes, format_size(self.hash_bytes)))
+        sys.stdout.write("To upload, at most:%s\n" % ("" if self.uploads else " nothing."))
+        for bucket_name, (n_files, n_bytes) in self.uploads.items():
+            sys.stdout.write("    %s: %d files, %s\n"
+                             % (bucket_name or '""', n_files, format_size(n_bytes)))
+        sys.stdout.write("Images to resize: %d\n" % len(self.images_to_resize))
+        sys.stdout.write(
+            "Files to publish: %d (%s of pages)\n"
+            % (len(self.changed_files), format_size(self.publish_bytes)))
+        for path, reason in self.changed_files:
+            sys.stdout.write("    %s: %s\n" % (path, reason))
+
+        estimate = self.get_estimate(throughput)
+        known = [(step, seconds) for step, seconds in estimate.items() if seconds]
+        sys.stdout.write(
+            "Estimated duration: %s (%s)\n"
+            % (format_duration(sum(seconds for _, seconds in known)),
+               ", ".join("%s %s" % (step, format_duration(seconds)) for step, seconds in known)
+               or "nothing to do"))
+        unknown = [step for step, seconds in estimate.items() if seconds is None]
+        if unknown:
+            sys.stdout.write(
+                "Not estimated, never measured by a run: %s.\n" % ", ".join(unknown))
+
+
+def plan_courses(course_slug_list):
+    plan = Plan()
+    for course_slug in course_slug_list:
+        plan.add_course(course_slug)
+    plan.write(load_throughput())
+    return plan
+
+
+class DatabaseWatcher(object):
+    """
+    Tell when the coursera-dl database changed: from SQLite's data version,
+    which changes when another connection commits, and from the files of the
+    database, in case it is replaced.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._connection = None
+        self._inode = None
+        self._state = self.get_state()
+
+    def _get_data_version(self):
+        try:
+            if self._connection is None:
+                self._connection = sqlite3.connect("file:%s?mode=ro" % self.db_path, uri=True)
+            return self._connection.execute("PRAGMA data_version").fetchone()[0]
+        except sqlite3.Error:
+            self.close()
+            return None
+
+    def get_state(self):
+        files = []
+        for path in [self.db_path, self.db_path + "-wal"]:
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                files.append(None)
+                continue
+            files.append((file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns))
+
+        # A new file, the connection still reads the old one.
+        inode = files[0][0] if files[0] else None
+        if inode != self._inode:
+            self.close()
+            self._inode = inode
+        return self._get_data_version(), files
+
+    def changed(self):
+        state = self.get_state()
+        changed = state != self._state
+        self._state = state
+        return changed
+
+    def wait(self, interval=WATCH_INTERVAL, debounce=WATCH_DEBOUNCE):
+        """
+        Return once the database changed, and then did not change for
+        ``debounce`` seconds.
+        """
+        while not self.changed():
+            time.sleep(interval)
+        quiet_since = time.time()
+        while time.time() - quiet_since < debounce:
+            time.sleep(min(interval, debounce))
+            if self.changed():
+                quiet_since = time.time()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def reset_run_state():
+    """
+    Forget what the last pass learnt which might not hold anymore, keeping
+    the rest (templates, clients, URLs of unchanged files). The buckets are
+    listed again, with the files uploaded by the last pass.
+    """
+    del build_summary[:]
+    instrumentation.pop()
+    upload_scheduler.forget()
+    batch_bucket_manager.forget()
+    bucket_index.forget()
+    asset_url_resolver.forget_changed()
+
+
+def get_argument_parser():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Convert courses downloaded by coursera-dl to RELATE flows.")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Number of processes converting modules in parallel "
+             "(default: %(default)s).")
+    parser.add_argument(
+        "--upload-workers", type=int, default=UPLOAD_WORKERS,
+        help="Number of concurrent uploads to Qiniu (default: %(default)s).")
+    parser.add_argument(
+        "--incremental", action="store_true", default=INCREMENTAL,
+        help="Only regenerate and publish the flows whose inputs changed since "
+             "the last run.")
+    parser.add_argument(
+        "--force-verify", action="store_true", default=FORCE_VERIFY,
+        help="Ignore the upload manifest, re-hash every file and check it "
+             "against the bucket.")
+    parser.add_argument(
+        "--report", default=RUN_REPORT_PATH, metavar="PATH",
+        help="Write the timings and counters of the run to PATH, as CSV if it "
+             "ends with .csv, else as JSON.")
+    parser.add_argument(
+        "--profile", metavar="COURSE_SLUG",
+        help="Only convert the course COURSE_SLUG, under a profiler.")
+    parser.add_argument(
+        "--profiler", choices=["cprofile", "pyinstrument"], default="cprofile",
+        help="Profiler of --profile (default: %(default)s).")
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="Keep running, and regenerate the flows affected by each change "
+             "of the database (implies --incremental).")
+    parser.add_argument(
+        "--watch-interval", type=float, default=WATCH_INTERVAL,
+        help="Seconds between the checks of the database (default: %(default)s).")
+    parser.add_argument(
+        "--watch-debounce", type=float, default=WATCH_DEBOUNCE,
+        help="Seconds the database must not have changed for before the flows "
+             "are regenerated (default: %(default)s).")
+    parser.add_argument(
+        "--plan", action="store_true",
+        help="Only report what a run would do (with the other options), and "
+             "estimate how long it would take.")
+    parser.add_argument(
+        "--bundle", metavar="DIR", default=BUNDLE_DIR,
+        help="Also write each course as a bundle in DIR, replaced at once when "
+             "the course is done.")
+    parser.add_argument(
+        "--bundle-format", choices=["dir", "tar"], default=BUNDLE_FORMAT,
+        help="A directory or a tar file per course (default: %(default)s).")
+    return parser
+
+
+def convert_courses(args):
+    course_slug_list = [c.course_slug for c in Course.select()]
+    if args.plan:
+        plan_courses(course_slug_list)
+        return
+
+    if args.profile:
+        profile_course(args.profile, args.profiler)
+    elif args.jobs > 1:
+        generate_yamls_parallel(course_slug_list, args.jobs)
+    else:
+        # for course_slug in course_slug_list:
+        #     remove_duplicate_files(course_slug, QINIU_BUCKET_NAME)
+        #     remove_specific_files(course_slug)
+        #     remove_specific_files(course_slug, extension=".jpg")
+        #     remove_specific_files(course_slug, extension=".png")
+        generate_all_yamls(course_slug_list)
+
+    write_build_summary()
+    asset_url_resolver.write_stats()
+    qiniu_retry_policy.write_stats()
+    dropbox_retry_policy.write_stats()
+    write_query_stats()
+    save_throughput()
+
+    if args.report:
+        instrumentation.write_report(args.report)
+        sys.stdout.write("Run report written to %s.\n" % args.report)
+
+
+def watch(args, watcher):
+    """
+    Convert the courses again each time the database changes, in the same
+    process, so that its warm state is kept. Only the flows whose inputs
+    changed are regenerated. ``watcher`` was started before the first pass,
+    so that the changes made during it are not missed.
+    """
+    try:
+        while True:
+            sys.stdout.write("---Watching %s for changes.---\n" % DB_PATH)
+            sys.stdout.flush()
+            watcher.wait(args.watch_interval, args.watch_debounce)
+            sys.stdout.write("---Database changed, converting.---\n")
+            reset_run_state()
+            convert_courses(args)
+    except KeyboardInterrupt:
+        sys.stdout.write("---Stopped watching.---\n")
+    finally:
+        watcher.close()
+
+
+def main():
+    global FORCE_VERIFY, INCREMENTAL, BUNDLE_DIR, BUNDLE_FORMAT
+
+    args = get_argument_parser().parse_args()
+    FORCE_VERIFY = args.force_verify
+    INCREMENTAL = args.incremental or args.watch
+    BUNDLE_DIR = args.bundle
+    BUNDLE_FORMAT = args.bundle_format
+    if BUNDLE_DIR:
+        os.makedirs(BUNDLE_DIR, exist_ok=True)
+    upload_scheduler.max_workers = args.upload_workers
+
+    if not upload_to_qiniu and not sys.platform.startswith("win"):
+        sys.stdout.write(
+            "Warning: QINIU_ACCESS_KEY, QINIU_SECRET_KEY, QINIU_BUCKET_NAME and "
+            "QINIU_VIDEO_BUCKET_PREFIX are not all set (nor STORAGE_BACKEND), "
+            "the files linked from the pages will not be uploaded.\n")
+
+    init_cache_database()
+
+    if not args.plan:
+        backup_database()
+
+    try:
+        ensure_lookup_indexes(create=not args.plan)
+        watcher = None
+        if args.watch and not args.plan:
+            watcher = DatabaseWatcher(DB_PATH)
+        convert_courses(args)
+        if watcher is not None:
+            watch(args, watcher)
 
     except OperationalError as e:
         if "no such table" in str(e):
@@ -661,6 +3906,11 @@ def main():
             sys.exit(1)
         else:
             raise e
+    finally:
+        upload_scheduler.shutdown()
+        shutdown_image_pool()
+        database.close()
+        cache_database.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# convert.py is a script at the root of the repository, not a package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,54 @@
+"""
+convert_normal_page() against a corpus of pages converted by its original
+implementation (data/normal_pages.json), with the same stand-ins for the
+course assets and their URLs: the output must not change by a byte.
+"""
+
+import os
+import json
+
+import pytest
+
+import convert
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), "data", "normal_pages.json")
+
+with open(DATA_PATH, encoding="utf-8") as f:
+    CASES = json.load(f)
+
+
+class FakeAsset(object):
+    def __init__(self, asset_id):
+        self.saved_path = "files/%s.bin" % asset_id
+
+
+class FakeCourseData(object):
+    """
+    A course whose assets all exist, except those whose id starts with
+    "missing".
+    """
+    course_slug = "course"
+
+    def get_course_asset(self, asset_id):
+        if asset_id.startswith("missing"):
+            return None
+        return FakeAsset(asset_id)
+
+
+class FakeItem(object):
+    def __init__(self, name, content):
+        self.name = name
+        self.content = content
+
+
+@pytest.fixture(autouse=True)
+def no_uploads(monkeypatch):
+    monkeypatch.setattr(convert, "upload_to_qiniu", False)
+    monkeypatch.setattr(
+        convert, "local_path_to_url", lambda course_slug, path: "%s/%s" % (course_slug, path))
+
+
+@pytest.mark.parametrize("case", CASES, ids=[str(i) for i in range(len(CASES))])
+def test_convert_normal_page(case):
+    item = FakeItem(case["name"], case["content"])
+    assert convert.convert_normal_page(item, FakeCourseData()) == case["expected"]
@@ -0,0 +1,35 @@
+"""
+qiniu_etag(), which hashes the 4M blocks of a file in parallel, against
+qiniu.etag, around the block boundaries.
+"""
+
+import random
+
+import pytest
+import qiniu
+
+import convert
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+SIZES = [0, 1, BLOCK_SIZE - 1, BLOCK_SIZE, BLOCK_SIZE + 1, 2 * BLOCK_SIZE + 1]
+
+
+def get_data(size):
+    if not size:
+        return b""
+    return random.Random(size).getrandbits(8 * size).to_bytes(size, "little")
+
+
+@pytest.mark.parametrize("hash_workers", [1, 4])
+@pytest.mark.parametrize("size", SIZES)
+def test_qiniu_etag(tmpdir, monkeypatch, size, hash_workers):
+    monkeypatch.setattr(convert, "HASH_WORKERS", hash_workers)
+    file_path = str(tmpdir.join("data"))
+    data = get_data(size)
+    with open(file_path, "wb") as f:
+        f.write(data)
+
+    expected = qiniu.etag(file_path)
+    assert convert.qiniu_etag(data) == expected
+    assert convert.hash_file(file_path) == expected